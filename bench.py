@@ -0,0 +1,1528 @@
+"""
+Local benchmarks for bot.py. Nothing here talks to Telegram or the real API.
+
+    python bench.py webhook --updates 2000 --bots 11
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import aiohttp
+from aiohttp import web
+
+import bot
+
+
+percentile = bot.percentile
+
+
+def report(name, count, elapsed, latencies):
+    print(
+        f"{name:<10} {count / elapsed:9.1f} updates/s   "
+        f"p50 {percentile(latencies, 50) * 1000:7.2f} ms   "
+        f"p99 {percentile(latencies, 99) * 1000:7.2f} ms"
+    )
+
+
+# --------- MOCK TELEGRAM BOT API ----------
+class MockBotAPI:
+    """
+    Minimal Bot API server. Serves getMe/getUpdates/setWebhook/getChatMember
+    and records the arrival time of every sendMessage per chat_id. With `flood_limit`
+    set, a chat that gets more than that many messages within one second
+    is answered with 429 and retry_after=1, like Telegram.
+    """
+
+    def __init__(self, flood_limit=None):
+        self.flood_limit = flood_limit
+        self.flooded = 0
+        self.pending = {}
+        self.waiters = {}
+        self.sent = {}
+        self.expected = {}
+        self.calls = {}
+        self.port = None
+        self._runner = None
+
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def expect(self, chat_id, *needles):
+        """
+        Future that resolves with the first text sent to `chat_id` that
+        contains one of `needles`. Register it before pushing the update.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.expected.setdefault(chat_id, []).append((needles, future))
+        return future
+
+    def deliver(self, chat_id, text):
+        waiting = self.expected.get(chat_id)
+        if not waiting:
+            return
+        for entry in list(waiting):
+            needles, future = entry
+            if future.done():
+                waiting.remove(entry)
+            elif any(needle in text for needle in needles):
+                future.set_result(text)
+                waiting.remove(entry)
+
+    def push(self, token, update):
+        self.pending.setdefault(token, []).append(update)
+        waiter = self.waiters.pop(token, None)
+        if waiter and not waiter.done():
+            waiter.set_result(None)
+
+    async def handle(self, request):
+        token = request.match_info["token"]
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(request.query)
+        if request.body_exists:
+            if request.content_type == "application/json":
+                params.update(await request.json())
+            else:
+                params.update(await request.post())
+
+        if method == "getMe":
+            result = {"id": int(token.split(":")[0]), "is_bot": True, "first_name": "Mock", "username": "mock_bot"}
+        elif method == "getUpdates":
+            offset = int(params.get("offset") or 0)
+            queue = [u for u in self.pending.get(token, []) if u["update_id"] >= offset]
+            self.pending[token] = queue
+            if not queue:
+                waiter = asyncio.get_running_loop().create_future()
+                self.waiters[token] = waiter
+                try:
+                    await asyncio.wait_for(waiter, float(params.get("timeout") or 0) or 0.1)
+                except asyncio.TimeoutError:
+                    pass
+                queue = self.pending.get(token, [])
+            result = queue[:100]
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id") or 0)
+            now = time.perf_counter()
+            recent = [t for t in self.sent.get(chat_id, []) if now - t < 1.0]
+            if self.flood_limit and len(recent) >= self.flood_limit:
+                self.flooded += 1
+                return web.json_response({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                }, status=429)
+            self.sent.setdefault(chat_id, []).append(now)
+            result = message_payload(chat_id, params.get("text", ""))
+            self.deliver(chat_id, result["text"])
+            if method == "editMessageText":
+                result["edit_date"] = int(time.time())
+        elif method == "getChatMember":
+            user_id = int(params.get("user_id") or 0)
+            result = {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "User"}}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, port=0):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+def message_payload(chat_id, text, user_id=None):
+    return {
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": user_id or chat_id, "is_bot": False, "first_name": "User"},
+        "text": text,
+    }
+
+
+def start_update(update_id, chat_id):
+    msg = message_payload(chat_id, "/start")
+    msg["entities"] = [{"type": "bot_command", "offset": 0, "length": 6}]
+    return {"update_id": update_id, "message": msg}
+
+
+def message_update(update_id, chat_id, text):
+    return {"update_id": update_id, "message": message_payload(chat_id, text)}
+
+
+def callback_update(update_id, chat_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": chat_id, "is_bot": False, "first_name": "User"},
+            "chat_instance": str(chat_id),
+            "message": message_payload(chat_id, "menu"),
+            "data": data,
+        },
+    }
+
+
+async def wait_for_replies(api, chat_ids, deadline=60):
+    end = time.perf_counter() + deadline
+    while time.perf_counter() < end:
+        if all(c in api.sent for c in chat_ids):
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError("handlers did not reply in time")
+
+
+async def start_fleet(api, bots):
+    tokens = {f"BOT{i}": f"{100000 + i}:bench" for i in range(1, bots + 1)}
+    apps = []
+    for key, token in tokens.items():
+        apps.append(await bot.run_bot(key, token, bot.CHANNEL_1, base_url=api.base_url()))
+    return tokens, apps
+
+
+async def stop_fleet(apps):
+    for app in apps:
+        bot.bot_apps.pop(app.bot_key, None)
+        if app.updater.running:
+            await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+
+
+# --------- WEBHOOK VS POLLING ----------
+async def bench_polling(updates, bots):
+    api = MockBotAPI()
+    await api.start()
+    bot.BOT_MODE = "polling"
+    tokens, apps = await start_fleet(api, bots)
+    keys = list(tokens)
+    sent_at = {}
+
+    begin = time.perf_counter()
+    for n in range(updates):
+        chat_id = n + 1
+        sent_at[chat_id] = time.perf_counter()
+        api.push(tokens[keys[n % len(keys)]], start_update(n + 1, chat_id))
+        if n % 50 == 0:
+            await asyncio.sleep(0)
+    await wait_for_replies(api, sent_at)
+    elapsed = time.perf_counter() - begin
+
+    report("polling", updates, elapsed, [api.sent[c][0] - t for c, t in sent_at.items()])
+    await stop_fleet(apps)
+    await api.stop()
+
+
+async def bench_webhook(updates, bots, concurrency=50):
+    api = MockBotAPI()
+    await api.start()
+    bot.BOT_MODE = "webhook"
+    bot.WEBHOOK_URL = "http://127.0.0.1"
+    tokens, apps = await start_fleet(api, bots)
+    keys = list(tokens)
+
+    config = bot.uvicorn.Config(bot.create_webhook_app(), host="127.0.0.1", port=0, log_level="warning")
+    server = bot.uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    sent_at = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession() as client:
+        async def post(n):
+            key = keys[n % len(keys)]
+            chat_id = n + 1
+            async with semaphore:
+                sent_at[chat_id] = time.perf_counter()
+                async with client.post(
+                    f"http://127.0.0.1:{port}/tg/{key}",
+                    data=json.dumps(start_update(n + 1, chat_id)),
+                    headers={
+                        "Content-Type": "application/json",
+                        "X-Telegram-Bot-Api-Secret-Token": bot.bot_apps[key].webhook_secret,
+                    },
+                ) as resp:
+                    assert resp.status == 200, resp.status
+
+        begin = time.perf_counter()
+        await asyncio.gather(*(post(n) for n in range(updates)))
+        await wait_for_replies(api, sent_at)
+        elapsed = time.perf_counter() - begin
+
+    report("webhook", updates, elapsed, [api.sent[c][0] - t for c, t in sent_at.items()])
+    server.should_exit = True
+    await server_task
+    await stop_fleet(apps)
+    await api.stop()
+
+
+async def run_webhook(args):
+    await bench_polling(args.updates, args.bots)
+    await bench_webhook(args.updates, args.bots)
+
+
+# --------- MOCK UPSTREAM API ----------
+class MockUpstream:
+    """
+    Stand-in for the claim API. Counts calls per path and answers after
+    `latency` seconds with a canned message, or with `message(request)` if
+    it is callable. Until `down_until` (perf_counter time) it answers 503,
+    and `error_rate` of the other calls get a 429 with Retry-After.
+    """
+
+    def __init__(self, latency=0.05, message="Please wait", error_rate=0.0):
+        self.latency = latency
+        self.message = message
+        self.error_rate = error_rate
+        self.down_until = 0.0
+        self.calls = {}
+        self.errors = 0
+        self.port = None
+        self._runner = None
+
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    async def handle(self, request):
+        self.calls[request.path] = self.calls.get(request.path, 0) + 1
+        await asyncio.sleep(self.latency)
+        if time.perf_counter() < self.down_until:
+            self.errors += 1
+            return web.json_response({"message": "down"}, status=503)
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({"message": "slow down"}, status=429, headers={"Retry-After": "1"})
+        message = self.message(request) if callable(self.message) else self.message
+        return web.json_response({"status": True, "message": message})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/api/{name}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+# --------- UPSTREAM POLLER ----------
+async def legacy_login(user_id, phone, results):
+    """
+    The per-user login loop message_handler used to start as a task.
+    """
+    for attempt in range(bot.LOGIN_MAX_ATTEMPTS):
+        data = await bot.fetch_json(f"{bot.API_BASE}/api/log?num={phone}")
+        msg = (data.get("message") or "").lower()
+        if "otp successfully generated" in msg:
+            results[user_id] = bot.OTP_SENT
+            return
+        await asyncio.sleep(bot.backoff_delay(attempt, data))
+    results[user_id] = None
+
+
+async def run_poller(args):
+    """
+    `--updates` users waiting on login at once. The API answers "Please wait"
+    until every user has polled once, then sends the OTP. Compares a task
+    per user with the shared poller on memory per pending user, API calls
+    and time from the OTP being ready to every user being resolved.
+    """
+    upstream = MockUpstream(latency=0.02)
+    await upstream.start()
+    bot.API_BASE = upstream.base_url()
+    await bot.init_session()
+    bot.api_limiter = bot.TokenBucket(1e9, 10 ** 9)
+    users = args.updates
+
+    for name in ("per-user", "poller"):
+        upstream.calls.clear()
+        upstream.message = "Please wait"
+        bot.response_cache.clear()
+        bot.api_breaker = bot.CircuitBreaker(bot.BREAKER_THRESHOLD, bot.BREAKER_RESET)
+        failed = sum(bot.upstream_errors.values.values())
+        results = {}
+        tracemalloc.start()
+        if name == "per-user":
+            tasks = [asyncio.create_task(legacy_login(n, f"0300{n:07d}", results)) for n in range(users)]
+        else:
+            futures = [bot.upstream_poller.submit(n, f"{bot.API_BASE}/api/log?num=0300{n:07d}", bot.LOGIN_OUTCOMES)
+                       for n in range(users)]
+        while upstream.total_calls() < users:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.1)
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        upstream.message = "OTP successfully generated"
+        ready = time.perf_counter()
+        if name == "per-user":
+            await asyncio.gather(*tasks)
+        else:
+            for n, outcome in enumerate(await asyncio.gather(*futures)):
+                results[n] = outcome
+        elapsed = time.perf_counter() - ready
+        assert sum(1 for v in results.values() if v == bot.OTP_SENT) == users
+        print(f"{name:<9} {held / users:8.0f} B/pending user   "
+              f"{upstream.total_calls() / users:5.2f} API calls/user   {elapsed:6.2f} s to resolve all   "
+              f"{sum(bot.upstream_errors.values.values()) - failed} failed requests")
+
+    bot.upstream_poller.stop()
+    await bot.close_session()
+    await upstream.stop()
+
+
+# --------- RESPONSE CLASSIFIER ----------
+CLASSIFIER_CORPUS = [
+    ({"status": True, "message": "OTP successfully generated"}, bot.OTP_SENT),
+    ({"status": True, "message": "Otp Successfully Generated for 03001234567"}, bot.OTP_SENT),
+    ({"status": False, "message": "PIN not allowed"}, bot.ALREADY_VERIFIED),
+    ({"status": True, "message": "OTP verified"}, bot.VERIFIED),
+    ({"status": False, "message": "Wrong OTP"}, bot.WRONG_OTP),
+    ({"status": False, "message": "Invalid OTP, success rate low"}, bot.WRONG_OTP),
+    ({"status": True, "message": "success"}, bot.ACTIVATED),
+    ({"status": True, "message": "Package Activated"}, bot.ACTIVATED),
+    ({"status": True, "message": "✅ Status: Your request has been successfully received"}, bot.ACTIVATED),
+    ({"status": False, "message": "Invalid number"}, bot.FATAL),
+    ({"status": False, "message": "This is not a Jazz number"}, bot.FATAL),
+    ({"status": False, "message": "Invalid number, success=false"}, bot.FATAL),
+    ({"status": False, "message": "Activation unsuccessful"}, bot.RETRYABLE),
+    ({"status": False, "message": "Request not successful"}, bot.RETRYABLE),
+    ({"status": False, "message": "Number not activated"}, bot.RETRYABLE),
+    ({"status": False, "message": "Activation failed, please retry"}, bot.RETRYABLE),
+    ({"status": False, "message": "success: false"}, bot.RETRYABLE),
+    ({"status": False, "message": "Package has not been activated yet"}, bot.RETRYABLE),
+    ({"status": False, "message": "Number could not be activated"}, bot.RETRYABLE),
+    ({"status": False, "message": "Package not yet activated"}, bot.RETRYABLE),
+    ({"status": False, "message": "Your package isn't activated"}, bot.RETRYABLE),
+    ({"status": False, "message": "Your package isn’t activated"}, bot.RETRYABLE),
+    ({"message": "Your request could not be successfully processed"}, bot.RETRYABLE),
+    ({"message": "Error: no success"}, bot.RETRYABLE),
+    ({"message": "Activation cannot be completed right now"}, bot.RETRYABLE),
+    ({"message": "Number was never activated"}, bot.RETRYABLE),
+    ({"status": False, "message": "Activated"}, bot.RETRYABLE),
+    ({"status": True, "message": "Done. Package activated successfully"}, bot.ACTIVATED),
+    ({"status": True, "message": "No issues found, package activated"}, bot.ACTIVATED),
+    ({"status": False, "message": "Please wait"}, bot.RETRYABLE),
+    ({"status": False, "message": ""}, bot.RETRYABLE),
+    ({"status": False}, bot.RETRYABLE),
+    ({"status": False, "message": None}, bot.RETRYABLE),
+    ({"status": False, "message": "Request failed: HTTP 503", "retry_after": 2}, bot.RETRYABLE),
+    ({"status": False, "message": "Request failed: success=false"}, bot.RETRYABLE),
+    ({"status": False, "message": "slow down", "retry_after": 1}, bot.RETRYABLE),
+    (["not", "a", "dict"], bot.RETRYABLE),
+]
+
+
+def legacy_classify(data):
+    """
+    The three substring chains the login, OTP and claim loops used to run.
+    """
+    msg = (data.get("message") or "").lower()
+    if "otp successfully generated" in msg:
+        return bot.OTP_SENT
+    if "pin not allowed" in msg:
+        return bot.ALREADY_VERIFIED
+    if "otp verified" in msg or "success" in msg:
+        return bot.VERIFIED
+    if "wrong otp" in msg or "invalid otp" in msg:
+        return bot.WRONG_OTP
+    if (
+        "success" in msg
+        or "activated" in msg
+        or "✅ status: your request has been successfully received".lower() in msg
+    ):
+        return bot.ACTIVATED
+    return bot.RETRYABLE
+
+
+async def run_classifier(args):
+    """
+    Checks classify_response against a corpus of upstream replies, then
+    times it, with and without its per-message cache, against the old
+    substring chains over `--updates` replies.
+    """
+    for data, expected in CLASSIFIER_CORPUS:
+        outcome = bot.classify_response(data)
+        assert outcome == expected, (data, outcome, expected)
+    print(f"corpus     {len(CLASSIFIER_CORPUS)} replies classified as expected")
+
+    replies = [data for data, _ in CLASSIFIER_CORPUS if isinstance(data, dict)]
+    replies = (replies * (args.updates // len(replies) + 1))[:args.updates]
+    uncached = bot.classify_message.__wrapped__
+
+    def compiled_uncached(data):
+        if not isinstance(data, dict) or data.get("retry_after"):
+            return bot.RETRYABLE
+        return uncached(str(data.get("message") or ""))
+
+    runs = (
+        ("legacy", legacy_classify),
+        ("uncached", compiled_uncached),
+        ("compiled", bot.classify_response),
+    )
+    for name, classify in runs:
+        begin = time.perf_counter()
+        for _ in range(20):
+            for data in replies:
+                classify(data)
+        elapsed = time.perf_counter() - begin
+        print(f"{name:<10} {elapsed / (20 * len(replies)) * 1e6:6.2f} µs/reply")
+
+
+# --------- RESPONSE CACHE ----------
+async def run_cache(args):
+    """
+    `--updates` concurrent pollers, 10 distinct numbers, 3 polling rounds.
+    """
+    upstream = MockUpstream()
+    await upstream.start()
+    bot.API_BASE = upstream.base_url()
+    await bot.init_session()
+    urls = [f"{bot.API_BASE}/api/log?num=0300000000{n % 10}" for n in range(args.updates)]
+
+    for name, fetch in (("uncached", bot.fetch_upstream), ("cached", bot.fetch_json)):
+        upstream.calls.clear()
+        begin = time.perf_counter()
+        for _ in range(3):
+            await asyncio.gather(*(fetch(url) for url in urls))
+            await asyncio.sleep(0.2)
+        elapsed = time.perf_counter() - begin
+        print(f"{name:<10} {upstream.total_calls():6d} upstream calls   {elapsed:6.2f} s")
+    print(f"{'stats':<10} {bot.cache_stats}")
+    assert upstream.total_calls() < args.updates
+
+    await bot.close_session()
+    await upstream.stop()
+
+
+# --------- RATE LIMIT / BACKOFF ----------
+async def run_limits(args):
+    """
+    `--updates` users claim one number each while the API is down for the
+    first 3 s and throttles 10% of calls afterwards.
+    """
+    upstream = MockUpstream(message="success", error_rate=0.1)
+    await upstream.start()
+    bot.API_BASE = upstream.base_url()
+    await bot.init_session()
+    adaptive_backoff = bot.backoff_delay
+
+    for name in ("fixed", "adaptive"):
+        if name == "fixed":
+            # the old behaviour: constant 0.5 s sleeps, no limiter, no breaker
+            bot.backoff_delay = lambda *a, **k: 0.5
+            bot.api_limiter = bot.TokenBucket(1e9, 10 ** 9)
+            bot.api_breaker = bot.CircuitBreaker(10 ** 9, 0)
+        else:
+            bot.backoff_delay = adaptive_backoff
+            bot.api_limiter = bot.TokenBucket(bot.API_RATE, bot.API_BURST)
+            bot.api_breaker = bot.CircuitBreaker(bot.BREAKER_THRESHOLD, 2.0)
+        upstream.calls.clear()
+        upstream.errors = 0
+        bot.activated_numbers = set()
+        bot.claim_ledger = bot.ClaimLedger(bot.StateStore(bot.MemoryBackend()), "claim_ledger")
+        upstream.down_until = time.perf_counter() + 3
+
+        messages = [FakeMessage(user_id) for user_id in range(1, args.updates + 1)]
+        begin = time.perf_counter()
+        await asyncio.gather(*(
+            bot.handle_claim_process(m, m.from_user.id, [f"03{m.from_user.id:09d}"], "5gb")
+            for m in messages
+        ))
+        elapsed = time.perf_counter() - begin
+        print(
+            f"{name:<10} {upstream.total_calls():6d} upstream calls   "
+            f"{upstream.errors:6d} wasted   {len(bot.activated_numbers):5d} activated   {elapsed:6.2f} s"
+        )
+
+    await bot.close_session()
+    await upstream.stop()
+
+
+# --------- OUTBOUND MESSAGES ----------
+async def legacy_claim(message, phones):
+    """
+    The claim loop as it was before the outbox: one reply per attempt.
+    """
+    for phone in phones:
+        for i in range(1, bot.request_count + 1):
+            data = await bot.fetch_json(f"{bot.API_BASE}/api/act?number={phone}")
+            try:
+                await bot.safe_reply(message, f"[{phone}] Request {i}:\n{json.dumps(data, indent=2, ensure_ascii=False)}")
+            except Exception as e:
+                try:
+                    await bot.safe_reply(message, f"[{phone}] Request {i}:\nError: {str(e)}")
+                except Exception:
+                    pass
+            await asyncio.sleep(bot.backoff_delay(i - 1))
+        try:
+            await bot.safe_reply(message, f"❌ All attempts failed for {phone}, please try again.")
+        except Exception:
+            pass
+
+
+async def run_outbox(args):
+    """
+    `--updates` users each claim 3 numbers that never activate (5 attempts each).
+    """
+    from telegram import Bot, Message
+
+    upstream = MockUpstream(latency=0.05)
+    await upstream.start()
+    bot.API_BASE = upstream.base_url()
+    await bot.init_session()
+    bot.api_limiter = bot.TokenBucket(1e9, 10 ** 9)
+    bot.backoff_delay = lambda *a, **k: 0.2
+
+    for name in ("legacy", "outbox"):
+        api = MockBotAPI(flood_limit=3)
+        await api.start()
+        tg = Bot("100001:bench", base_url=api.base_url())
+        await tg.initialize()
+        bot.outboxes.clear()
+        messages = [
+            Message.de_json(message_payload(user_id, "03001234567"), tg)
+            for user_id in range(1, args.updates + 1)
+        ]
+        phones = ["03000000001", "03000000002", "03000000003"]
+
+        begin = time.perf_counter()
+        if name == "legacy":
+            await asyncio.gather(*(legacy_claim(m, phones) for m in messages))
+        else:
+            await asyncio.gather(*(
+                bot.handle_claim_process(m, m.chat.id, phones, "5gb", "bench") for m in messages
+            ))
+        elapsed = time.perf_counter() - begin
+        await asyncio.gather(*bot.outbox_for("bench").pending)
+
+        delivered = sum(len(v) for v in api.sent.values())
+        print(
+            f"{name:<10} {delivered / len(messages):6.1f} messages/claim   "
+            f"{api.flooded:5d} flood errors   claim wall time {elapsed:6.2f} s"
+        )
+        await tg.shutdown()
+        await api.stop()
+
+    await bot.close_session()
+    await upstream.stop()
+
+
+# --------- PARALLEL CLAIMS ----------
+async def run_parallel(args):
+    """
+    Wall time of one claim against a 200 ms API for growing number counts.
+    """
+    upstream = MockUpstream(latency=0.2, message="success")
+    await upstream.start()
+    bot.API_BASE = upstream.base_url()
+    await bot.init_session()
+    bot.api_limiter = bot.TokenBucket(1e9, 10 ** 9)
+    parallelism = bot.CLAIM_PARALLELISM
+
+    for count in (1, 5, 10, 20):
+        phones = [f"0300{n:07d}" for n in range(count)]
+        row = []
+        for name, limit in (("sequential", 1), ("parallel", parallelism)):
+            bot.CLAIM_PARALLELISM = limit
+            bot.claim_ledger = bot.ClaimLedger(bot.StateStore(bot.MemoryBackend()), "claim_ledger")
+            message = FakeMessage(count)
+            begin = time.perf_counter()
+            await bot.handle_claim_process(message, count, phones + phones[:1], "5gb", "bench")
+            row.append(f"{name} {time.perf_counter() - begin:6.2f} s")
+        print(f"{count:3d} numbers   " + "   ".join(row))
+
+    bot.CLAIM_PARALLELISM = parallelism
+    await bot.close_session()
+    await upstream.stop()
+
+
+# --------- MEMBERSHIP CACHE ----------
+class FakeBot:
+    """
+    get_chat_member with 50 ms latency and a call counter.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    async def get_chat_member(self, chat_id, user_id):
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        return SimpleNamespace(status="member")
+
+
+async def run_membership(args):
+    """
+    `--updates` users press "I have joined" 3 times each, spread over
+    `--bots` bots that require the same 3 channels.
+    """
+    channels = [{"name": f"Channel {n}", "link": "https://t.me/x", "id": f"-100{n}"} for n in range(3)]
+    ttls = (bot.MEMBERSHIP_TTL, bot.MEMBERSHIP_NEGATIVE_TTL)
+
+    for name, (ttl, negative_ttl) in (("uncached", (0, 0)), ("cached", ttls)):
+        bot.MEMBERSHIP_TTL, bot.MEMBERSHIP_NEGATIVE_TTL = ttl, negative_ttl
+        bot.membership_cache.clear()
+        fake_bot = FakeBot()
+        latencies = []
+        begin = time.perf_counter()
+        for press in range(3):
+            for user_id in range(1, args.updates + 1):
+                context = SimpleNamespace(bot=fake_bot, application=SimpleNamespace(
+                    bot_channels=channels, bot_key=f"BOT{(user_id + press) % args.bots}"
+                ))
+                query = FakeMessage(user_id, data="joined")
+                started = time.perf_counter()
+                await bot.button_handler(SimpleNamespace(callback_query=query), context)
+                latencies.append(time.perf_counter() - started)
+        elapsed = time.perf_counter() - begin
+        print(
+            f"{name:<10} {fake_bot.calls:6d} get_chat_member calls   "
+            f"p50 {percentile(latencies, 50) * 1000:7.2f} ms   "
+            f"p99 {percentile(latencies, 99) * 1000:7.2f} ms   {elapsed:6.2f} s"
+        )
+
+    bot.MEMBERSHIP_TTL, bot.MEMBERSHIP_NEGATIVE_TTL = ttls
+
+
+# --------- MENUS ----------
+async def legacy_start(update, context):
+    """
+    /start as it was before the menu registry: the keyboard is rebuilt per call.
+    """
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+    channels = getattr(context.application, "bot_channels", [])
+    channel_buttons = []
+    for i in range(0, len(channels), 2):
+        channel_buttons.append([InlineKeyboardButton(ch["name"], url=ch["link"]) for ch in channels[i:i + 2]])
+    channel_buttons.append([InlineKeyboardButton("I have joined", callback_data="joined")])
+    await bot.safe_reply(
+        update.message,
+        "Welcome! Please join the channels below and then press 'I have joined':",
+        reply_markup=InlineKeyboardMarkup(channel_buttons)
+    )
+
+
+async def run_menus(args):
+    shared = {id(bot.channel_menu(cfg["channels"])) for cfg in bot.TOKENS.values()}
+    print(f"{len(bot.TOKENS)} bots share {len(shared)} /start keyboards")
+
+    application = SimpleNamespace(bot_channels=bot.CHANNEL_1, start_menu=bot.channel_menu(bot.CHANNEL_1))
+    context = SimpleNamespace(application=application)
+    for name, handler in (("rebuilt", legacy_start), ("shared", bot.start)):
+        update = SimpleNamespace(message=FakeMessage(1))
+        begin = time.perf_counter()
+        for _ in range(args.updates):
+            await handler(update, context)
+        elapsed = time.perf_counter() - begin
+        print(f"{name:<10} {elapsed / args.updates * 1e6:8.2f} us per /start")
+
+
+# --------- STARTUP ----------
+class FakeApplication:
+    """
+    Application stand-in whose initialize() takes `delay` seconds (the getMe
+    round trip) and fails for tokens listed in `failing` the first time.
+    """
+
+    failing = set()
+
+    def __init__(self, token, delay):
+        self.token = token
+        self.delay = delay
+        self.running = False
+        self.bot = SimpleNamespace(set_webhook=self._noop)
+        self.updater = SimpleNamespace(running=False, start_polling=self._start_polling, stop=self._noop)
+
+    async def _noop(self, *args, **kwargs):
+        await asyncio.sleep(self.delay / 10)
+
+    async def _start_polling(self, *args, **kwargs):
+        await asyncio.sleep(self.delay / 10)
+        self.updater.running = True
+
+    def add_handler(self, *args, **kwargs):
+        pass
+
+    def add_error_handler(self, *args, **kwargs):
+        pass
+
+    async def initialize(self):
+        await asyncio.sleep(self.delay)
+        if self.token in self.failing:
+            self.failing.discard(self.token)
+            raise RuntimeError("Conflict: terminated by other getUpdates request")
+
+    async def start(self):
+        self.running = True
+
+    async def stop(self):
+        await asyncio.sleep(self.delay / 10)
+        self.running = False
+
+    async def shutdown(self):
+        await asyncio.sleep(self.delay / 10)
+
+
+class FakeApplicationBuilder:
+    delay = 0.5
+
+    def token(self, token):
+        self._token = token
+        return self
+
+    def base_url(self, url):
+        return self
+
+    def build(self):
+        return FakeApplication(self._token, self.delay)
+
+
+async def run_startup(args):
+    """
+    Fleet startup/shutdown time with a 0.5 s initialize() per bot. One bot
+    fails its first attempt and is retried in the background.
+    """
+    real_builder = bot.ApplicationBuilder
+    bot.ApplicationBuilder = FakeApplicationBuilder
+    bot.STARTUP_RETRY_DELAY = 0.5
+    for count in (1, 4, 11, 16):
+        tokens = {f"BOT{n}": {"token": f"{n}:fake", "channels": bot.CHANNEL_1} for n in range(count)}
+        FakeApplication.failing = {f"{count - 1}:fake"} if count > 1 else set()
+        bots = []
+        begin = time.perf_counter()
+        tasks = await bot.start_bots(tokens, bots)
+        started = time.perf_counter() - begin
+        first_pass = len(bots)
+        await asyncio.gather(*tasks)
+        retried = time.perf_counter() - begin
+        begin = time.perf_counter()
+        await asyncio.gather(*(bot.stop_bot(app) for app in bots))
+        stopped = time.perf_counter() - begin
+        print(
+            f"{count:3d} bots   first pass {started:5.2f} s ({first_pass} up)   "
+            f"all up {retried:5.2f} s   shutdown {stopped:5.2f} s"
+        )
+    bot.ApplicationBuilder = real_builder
+
+
+# --------- SHARDING ----------
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve_mock_bot_api(port):
+    async def serve():
+        api = MockBotAPI()
+        await api.start(port)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def drive_shards(workers, updates, tmp):
+    """
+    Start `workers` shard processes in webhook mode and POST `updates`
+    updates round-robin over all bots to the supervisor's public listener.
+    Returns updates/s as counted by the shards.
+    """
+    webhook_port = free_port()
+    bot.WEBHOOK_PORT = webhook_port
+    os.environ.update({
+        "WEBHOOK_PORT": str(webhook_port),
+        "STATE_DB": os.path.join(tmp, f"shards-{workers}.db"),
+    })
+    store = bot.SQLiteBackend(os.environ["STATE_DB"])
+    supervisor = bot.ShardSupervisor(bot.shard_assignment(bot.TOKENS, workers))
+    supervisor.start()
+    client = aiohttp.ClientSession()
+    server = supervisor.forward_server(client)
+    server_task = asyncio.create_task(server.serve())
+
+    def totals():
+        rows = store.load_all("shard_stats").values()
+        return sum(r["bots"] for r in rows), sum(r["updates"] for r in rows)
+
+    try:
+        while totals()[0] < len(bot.TOKENS):
+            await asyncio.sleep(0.2)
+
+        keys = list(bot.TOKENS)
+        semaphore = asyncio.Semaphore(100)
+        async with aiohttp.ClientSession() as client:
+            async def post(n):
+                key = keys[n % len(keys)]
+                async with semaphore:
+                    async with client.post(
+                        f"http://127.0.0.1:{webhook_port}/tg/{key}",
+                        data=json.dumps(start_update(n + 1, n + 1)),
+                        headers={
+                            "Content-Type": "application/json",
+                            "X-Telegram-Bot-Api-Secret-Token": bot.webhook_secret(key, bot.TOKENS[key]["token"]),
+                        },
+                    ) as resp:
+                        assert resp.status == 200, resp.status
+
+            begin = time.perf_counter()
+            await asyncio.gather(*(post(n) for n in range(updates)))
+            while totals()[1] < updates:
+                await asyncio.sleep(0.05)
+            return updates / (time.perf_counter() - begin)
+    finally:
+        server.should_exit = True
+        await server_task
+        await client.close()
+        supervisor.stop()
+        store.close()
+
+
+async def run_shards(args):
+    """
+    updates/s for 1 shard process vs `--workers` shard processes. The real
+    bot tokens are only ever sent to the local mock Bot API.
+    """
+    mock_port = free_port()
+    mock = multiprocessing.get_context("spawn").Process(target=serve_mock_bot_api, args=(mock_port,))
+    mock.start()
+    os.environ.update({
+        "BOT_MODE": "webhook",
+        "WEBHOOK_URL": "http://127.0.0.1",
+        "BOT_API_URL": f"http://127.0.0.1:{mock_port}/bot",
+        "STATE_BACKEND": "sqlite",
+        "STATE_FLUSH_INTERVAL": "0.2",
+    })
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for workers in sorted({1, args.workers}):
+                rate = await drive_shards(workers, args.updates, tmp)
+                print(f"{workers:3d} process(es)   {rate:9.1f} updates/s")
+    finally:
+        mock.terminate()
+        mock.join()
+
+
+# --------- METRICS ----------
+async def run_metrics(args):
+    """
+    Cost of the instrumentation on the /start handler, and a /metrics sample.
+    """
+    application = SimpleNamespace(bot_channels=bot.CHANNEL_1, start_menu=bot.channel_menu(bot.CHANNEL_1))
+    context = SimpleNamespace(application=application)
+    update = SimpleNamespace(message=FakeMessage(1))
+    timed_start = bot.instrumented(bot.start)
+    for name, handler in (("plain", bot.start), ("instrumented", timed_start)):
+        begin = time.perf_counter()
+        for _ in range(args.updates):
+            await handler(update, context)
+        print(f"{name:<13} {(time.perf_counter() - begin) / args.updates * 1e6:8.2f} us per /start")
+
+    begin = time.perf_counter()
+    text = bot.render_metrics()
+    print(f"render        {(time.perf_counter() - begin) * 1000:8.2f} ms, {len(text.splitlines())} lines")
+    print("\n".join(line for line in text.splitlines() if line.startswith("handler_seconds_count")))
+
+
+# --------- HTTP CLIENT ----------
+async def run_http(args):
+    """
+    Old session setup vs the tuned shared session at 1, 100 and 1000
+    concurrent fetches, over several rounds so keep-alive reuse shows up.
+    Loopback has no DNS or TLS cost, so this mostly checks for regressions.
+    """
+    upstream = MockUpstream(latency=0.01)
+    await upstream.start()
+    url = f"{upstream.base_url()}/api/log?num=03000000000"
+
+    def default_session():
+        # the session as init_session built it before: same headers, default connector
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(bot.count_new_connection)
+        trace.on_connection_reuseconn.append(bot.count_reused_connection)
+        return aiohttp.ClientSession(trace_configs=[trace], headers={
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+            "Accept": "application/json, text/plain, */*",
+            "Content-Type": "application/json"
+        })
+
+    async def tuned_session():
+        await bot.init_session()
+        return bot.session
+
+    for concurrency in (1, 100, 1000):
+        for name in ("default", "tuned"):
+            session = default_session() if name == "default" else await tuned_session()
+            loads = json.loads if name == "default" else bot.json_loads
+            bot.http_stats.update(new=0, reused=0)
+
+            timeout = 10 if name == "default" else None
+
+            async def fetch():
+                async with session.get(url, **({"timeout": timeout} if timeout else {})) as resp:
+                    return await resp.json(loads=loads)
+
+            rounds = max(3, 300 // concurrency)
+            begin = time.perf_counter()
+            for _ in range(rounds):
+                await asyncio.gather(*(fetch() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - begin
+            await session.close()
+            print(
+                f"{concurrency:5d} concurrent  {name:<8} {concurrency * rounds / elapsed:8.1f} req/s   "
+                f"{bot.http_stats['new']:5d} connections opened, {bot.http_stats['reused']:5d} reused"
+            )
+
+    await upstream.stop()
+
+
+# --------- STATE STORE ----------
+class FakeMessage:
+    """
+    Stands in for telegram.Message/CallbackQuery so handlers run without I/O.
+    """
+
+    def __init__(self, user_id, text="", data=None):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.chat = SimpleNamespace(id=user_id)
+        self.text = text
+        self.data = data
+        self.message = self
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+    async def edit_message_text(self, text, **kwargs):
+        self.replies.append(text)
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+async def drive_handlers(users):
+    """
+    One state write (claim menu callback) and one state read (phone message) per user.
+    """
+    begin = time.perf_counter()
+    for user_id in range(1, users + 1):
+        query = FakeMessage(user_id, data="claim_5gb")
+        await bot.button_handler(SimpleNamespace(callback_query=query), SimpleNamespace(application=None))
+        message = FakeMessage(user_id, text="not-a-number")
+        await bot.message_handler(SimpleNamespace(message=message), None)
+    return time.perf_counter() - begin
+
+
+async def run_state(args):
+    users = args.updates
+    memory = bot.StateStore(bot.MemoryBackend())
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite = bot.StateStore(bot.SQLiteBackend(os.path.join(tmp, "state.db")))
+        for name, store in (("memory", memory), ("sqlite", sqlite)):
+            bot.state_store = store
+            bot.user_states = bot.SessionStore(store, "user_states")
+            store.start()
+            elapsed = await drive_handlers(users)
+            flush_begin = time.perf_counter()
+            await store.close()
+            flushed = time.perf_counter() - flush_begin
+            print(
+                f"{name:<10} {users * 2 / elapsed:9.1f} handler calls/s   "
+                f"final flush {flushed * 1000:7.2f} ms"
+            )
+
+        # cold start: a fresh store only touches the users it is asked about
+        begin = time.perf_counter()
+        store = bot.StateStore(bot.SQLiteBackend(os.path.join(tmp, "state.db")))
+        states = bot.SessionStore(store, "user_states")
+        opened = time.perf_counter() - begin
+        assert states.get(users).stage == bot.STAGE_AWAITING_PHONE_FOR_CLAIM
+        print(f"{'reopen':<10} {opened * 1000:9.2f} ms to open a store with {users} users")
+        await store.close()
+
+
+# --------- USER JOURNEYS ----------
+JOURNEY_PROFILES = {
+    "fast": {"latency": 0.02, "error_rate": 0.0},
+    "slow": {"latency": 0.3, "error_rate": 0.0},
+    "flaky": {"latency": 0.05, "error_rate": 0.1},
+}
+
+
+def journey_reply(request):
+    if request.path == "/api/log":
+        return "OTP verified" if "otp" in request.query else "OTP successfully generated"
+    return "✅ Status: Your request has been successfully received"
+
+
+async def journey(api, token, chat_id, update_ids, timeout=120):
+    """
+    One user from /start to a finished claim. Each step pushes an update
+    and waits for the reply that moves the user on. Returns True if the
+    claim went through.
+    """
+    phone = f"03{chat_id:09d}"
+    steps = (
+        (start_update, "/start", ("Welcome!",)),
+        (callback_update, "joined", ("You have joined all required channels",)),
+        (callback_update, "login", ("receive OTP",)),
+        (message_update, phone, ("OTP sent successfully",)),
+        (message_update, "1234", ("OTP verified successfully",)),
+        (callback_update, "claim_menu", ("Choose your claim option",)),
+        (callback_update, "claim_5gb", ("activate your claim",)),
+        (message_update, phone, ("Package successfully activated", "All attempts failed")),
+    )
+    for build, value, needles in steps:
+        reply = api.expect(chat_id, *needles)
+        if build is start_update:
+            api.push(token, start_update(next(update_ids), chat_id))
+        else:
+            api.push(token, build(next(update_ids), chat_id, value))
+        text = await asyncio.wait_for(reply, timeout)
+    return "activated" in text
+
+
+async def run_journeys(args):
+    """
+    `--updates` scripted users go /start -> joined -> login -> OTP -> claim
+    through the real handlers, with `--bots` bots polling a mock Bot API and
+    a mock claim API per latency/error profile. At most 200 users are mid
+    journey at once. Reports journeys/s, p50/p99 journey time, claim API
+    calls per journey and peak RSS.
+    """
+    bot.BOT_MODE = "polling"
+    update_ids = itertools.count(1)
+    for index, (name, profile) in enumerate(JOURNEY_PROFILES.items()):
+        upstream = MockUpstream(message=journey_reply, **profile)
+        await upstream.start()
+        bot.API_BASE = upstream.base_url()
+        await bot.init_session()
+        bot.api_limiter = bot.TokenBucket(1e9, 10 ** 9)
+        bot.api_breaker = bot.CircuitBreaker(bot.BREAKER_THRESHOLD, bot.BREAKER_RESET)
+        bot.response_cache.clear()
+        bot.outboxes.clear()
+        # a stopped scheduler or poller stays stopped
+        bot.claim_scheduler = bot.ClaimScheduler(bot.CLAIM_WORKERS)
+        bot.upstream_poller = bot.UpstreamPoller()
+        api = MockBotAPI()
+        await api.start()
+        tokens, apps = await start_fleet(api, args.bots)
+        keys = list(tokens)
+        semaphore = asyncio.Semaphore(200)
+        latencies = []
+        failed = 0
+
+        async def user(n):
+            nonlocal failed
+            chat_id = (index + 1) * 10 ** 7 + n
+            async with semaphore:
+                begin = time.perf_counter()
+                try:
+                    claimed = await journey(api, tokens[keys[n % len(keys)]], chat_id, update_ids)
+                except asyncio.TimeoutError:
+                    claimed = False
+                if claimed:
+                    latencies.append(time.perf_counter() - begin)
+                else:
+                    failed += 1
+
+        begin = time.perf_counter()
+        await asyncio.gather(*(user(n) for n in range(args.updates)))
+        elapsed = time.perf_counter() - begin
+        print(
+            f"{name:<6} {args.updates / elapsed:7.1f} journeys/s   "
+            f"p50 {percentile(latencies, 50):6.2f} s   p99 {percentile(latencies, 99):6.2f} s   "
+            f"{upstream.total_calls() / args.updates:5.2f} API calls/journey   {failed} failed"
+        )
+
+        await bot.claim_scheduler.stop()
+        bot.upstream_poller.stop()
+        await asyncio.gather(*(p for o in bot.outboxes.values() for p in o.pending))
+        await stop_fleet(apps)
+        await api.stop()
+        await bot.close_session()
+        await upstream.stop()
+
+    print(f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+# --------- CONFIG RELOAD ----------
+def write_config(path, bots, channels):
+    config = {"channels": channels, "bots": bots}
+    with open(path + ".tmp", "w") as f:
+        json.dump(config, f)
+    os.replace(path + ".tmp", path)
+
+
+async def run_reload(args):
+    """
+    Three bots polling the mock Bot API from a BOT_CONFIG file, with /start
+    traffic to BOT1 throughout. The file is then edited live: new channels
+    for BOT2, BOT4 added, BOT3 removed, a new token for BOT2 and finally a
+    broken file. Reports each reload's latency and BOT1's replies meanwhile.
+    """
+    api = MockBotAPI()
+    await api.start()
+    bot.BOT_MODE = "polling"
+    bot.CONFIG_POLL_INTERVAL = 0.05
+    channels = {
+        "A": [{"name": "A", "link": "https://t.me/a", "id": "-1001"}],
+        "B": [{"name": "B", "link": "https://t.me/b", "id": "-1002"}],
+    }
+    bots = {f"BOT{n}": {"token": f"{100000 + n}:bench", "channels": "A", "base_url": api.base_url()}
+            for n in (1, 2, 3)}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bots.json")
+        write_config(path, bots, channels)
+        bot.BOT_CONFIG = path
+        bot.TOKENS, bot.API_BASE = bot.read_bot_config()
+        running = []
+        await bot.start_bots(bot.TOKENS, running)
+        watcher = asyncio.create_task(bot.config_watch_loop(running))
+        update_ids = itertools.count(1)
+
+        latencies = []
+        missed = 0
+        done = asyncio.Event()
+
+        async def traffic():
+            nonlocal missed
+            chat_id = 1
+            while not done.is_set():
+                reply = api.expect(chat_id, "Welcome!")
+                sent = time.perf_counter()
+                api.push(bots["BOT1"]["token"], start_update(next(update_ids), chat_id))
+                try:
+                    await asyncio.wait_for(reply, 5)
+                    latencies.append(time.perf_counter() - sent)
+                except asyncio.TimeoutError:
+                    missed += 1
+                chat_id += 1
+                await asyncio.sleep(0.01)
+
+        async def reload(name, check):
+            reloads, failed = bot.config_stats["reloads"], bot.config_stats["failed"]
+            began = time.perf_counter()
+            write_config(path, bots, channels)
+            while (bot.config_stats["reloads"], bot.config_stats["failed"]) == (reloads, failed):
+                await asyncio.sleep(0.005)
+            applied = time.perf_counter() - began
+            assert check(), name
+            print(f"{name:<22} reload {bot.config_stats['last_reload'] * 1000:7.1f} ms   "
+                  f"applied {applied * 1000:7.1f} ms after the write")
+
+        driver = asyncio.create_task(traffic())
+        await asyncio.sleep(0.5)
+
+        bot1, bot2 = bot.bot_apps["BOT1"], bot.bot_apps["BOT2"]
+        bots["BOT2"]["channels"] = "B"
+        await reload("BOT2 new channels",
+                     lambda: bot.bot_apps["BOT2"] is bot2 and bot2.bot_channels == channels["B"])
+        bots["BOT4"] = {"token": "100004:bench", "channels": "B", "base_url": api.base_url()}
+        await reload("BOT4 added", lambda: "BOT4" in bot.bot_apps)
+        del bots["BOT3"]
+        await reload("BOT3 removed", lambda: "BOT3" not in bot.bot_apps)
+        bots["BOT2"]["token"] = "100022:bench"
+        await reload("BOT2 new token", lambda: bot.bot_apps["BOT2"] is not bot2)
+
+        reloads = bot.config_stats["reloads"]
+        failed = bot.config_stats["failed"]
+        with open(path, "w") as f:
+            f.write("{broken")
+        while bot.config_stats["failed"] == failed:
+            await asyncio.sleep(0.005)
+        assert bot.config_stats["reloads"] == reloads and len(bot.bot_apps) == 3
+        print(f"{'broken file':<22} rejected, {len(bot.bot_apps)} bots still running")
+
+        reply = api.expect(10 ** 6, "Welcome!")
+        api.push(bots["BOT4"]["token"], start_update(next(update_ids), 10 ** 6))
+        await asyncio.wait_for(reply, 5)
+
+        done.set()
+        await driver
+        watcher.cancel()
+        assert bot.bot_apps["BOT1"] is bot1
+        print(f"BOT1 kept serving: {len(latencies)} /start replies, {missed} missed, "
+              f"p50 {percentile(latencies, 50) * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms")
+        await stop_fleet(list(bot.bot_apps.values()))
+    await api.stop()
+
+
+# --------- SESSIONS ----------
+def session_bytes(variant, users):
+    """
+    tracemalloc bytes per logged-in user for one way of holding sessions.
+    """
+    tracemalloc.start()
+    if variant == "dict":
+        states = {}
+        for n in range(users):
+            states[n] = {"stage": "logged_in", "phone": f"0300{n:07d}"}
+    else:
+        states = bot.SessionStore(bot.StateStore(bot.MemoryBackend()), "user_states", ttl=3600)
+        for n in range(users):
+            states.set(n, bot.STAGE_LOGGED_IN, phone=f"0300{n:07d}")
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return held / users
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def simulate_sessions(variant, users, ttl, cap):
+    """
+    Runs in a fresh process: `users` distinct users each start a session and
+    send one message. Returns RSS before and after in MB, live sessions
+    and seconds.
+    """
+    baseline = rss_mb()
+    begin = time.perf_counter()
+    if variant == "dict":
+        states = {}
+        for n in range(users):
+            states[n] = {"stage": "logged_in", "phone": f"0300{n:07d}"}
+            states.get(n, {}).get("stage")
+    else:
+        states = bot.SessionStore(bot.StateStore(bot.MemoryBackend()), "user_states", ttl=ttl, max_sessions=cap)
+        for n in range(users):
+            states.set(n, bot.STAGE_LOGGED_IN, phone=f"0300{n:07d}")
+            states.get(n)
+    elapsed = time.perf_counter() - begin
+    return baseline, rss_mb(), len(states), elapsed
+
+
+async def run_sessions(args):
+    """
+    Memory of the plain dict-per-user states vs SessionStore: bytes per user,
+    then RSS after a `--users` run with no eviction, a 1 s idle TTL and a
+    100k cap. Each run gets its own process so peaks do not mix.
+    """
+    for variant in ("dict", "sessions"):
+        print(f"{variant:<18} {session_bytes(variant, 100_000):7.0f} B/user")
+
+    context = multiprocessing.get_context("spawn")
+    runs = (
+        ("dict", float("inf"), 0),
+        ("sessions", float("inf"), 0),
+        ("sessions ttl=1s", 1.0, 0),
+        ("sessions cap=100k", float("inf"), 100_000),
+    )
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for name, ttl, cap in runs:
+            variant = name.split()[0]
+            baseline, rss, live, elapsed = pool.apply(simulate_sessions, (variant, args.users, ttl, cap))
+            print(f"{name:<18} {rss:7.1f} MB RSS (+{rss - baseline:5.1f})   {live:8d} live sessions   "
+                  f"{args.users / elapsed:9.0f} users/s")
+
+
+# --------- CANCELLATION ----------
+async def legacy_flag_claim(user_id, url, flags):
+    """
+    The old stop mechanism: a flag checked between requests and 2 s sleeps.
+    """
+    for _ in range(bot.request_count):
+        if flags.get(user_id):
+            return
+        await bot.fetch_json(url)
+        await asyncio.sleep(2)
+
+
+async def run_cancel(args):
+    """
+    `--updates` claims against a 2 s API that never succeeds. Measures how
+    long /stop takes to end them with the old flag and with cancel_user(),
+    how long a shutdown with a 1 s grace takes, and when a claim deadline fires.
+    Also reports the upstream requests still in flight afterwards.
+    """
+    upstream = MockUpstream(latency=2.0, message="Please wait")
+    await upstream.start()
+    bot.API_BASE = upstream.base_url()
+    await bot.init_session()
+    bot.api_limiter = bot.TokenBucket(1e9, 10 ** 9)
+    users = min(args.updates, 90)
+    bot.claim_slots = asyncio.Semaphore(users)
+
+    def phone(n):
+        return f"0300{n:07d}"
+
+    # old: flag between requests
+    flags = {}
+    tasks = [asyncio.create_task(legacy_flag_claim(n, f"{bot.API_BASE}/api/act?number={phone(n)}", flags))
+             for n in range(users)]
+    await asyncio.sleep(0.5)
+    begin = time.perf_counter()
+    for n in range(users):
+        flags[n] = True
+    await asyncio.gather(*tasks)
+    print(f"{'flag':<10} all stopped after {time.perf_counter() - begin:5.2f} s")
+
+    async def submit_all():
+        bot.claim_scheduler = bot.ClaimScheduler(users)
+        bot.outboxes.clear()
+        messages = [FakeMessage(n) for n in range(users)]
+        for n, message in enumerate(messages):
+            bot.claim_scheduler.submit(bot.ClaimJob("bench", n, message, [phone(n)], "5gb"))
+        await asyncio.sleep(0.5)
+        return messages
+
+    # new: Task.cancel() through cancel_user
+    await submit_all()
+    tasks = [job.task for job in bot.claim_scheduler.jobs.values()]
+    begin = time.perf_counter()
+    for n in range(users):
+        bot.cancel_user(n)
+    await asyncio.wait(tasks)
+    print(f"{'cancel':<10} all stopped after {time.perf_counter() - begin:5.2f} s   "
+          f"{len(bot.inflight_requests)} requests still in flight")
+    await bot.claim_scheduler.stop()
+
+    # shutdown with a grace period
+    await submit_all()
+    begin = time.perf_counter()
+    await bot.claim_scheduler.stop(grace=1.0)
+    print(f"{'shutdown':<10} done after {time.perf_counter() - begin:5.2f} s (grace 1 s)   "
+          f"{len(bot.inflight_requests)} requests still in flight")
+
+    # deadline
+    deadline = bot.CLAIM_DEADLINE
+    bot.CLAIM_DEADLINE = 1.0
+    begin = time.perf_counter()
+    messages = await submit_all()
+    await asyncio.wait([job.task for job in bot.claim_scheduler.jobs.values()])
+    elapsed = time.perf_counter() - begin
+    # the deadline notice goes through the rate-limited outbox
+    await bot.drain_outboxes(30)
+    timed_out = sum(1 for m in messages if any("took too long" in r for r in m.replies))
+    print(f"{'deadline':<10} {timed_out}/{users} claims stopped at the 1 s deadline "
+          f"({elapsed:5.2f} s after submit)")
+    bot.CLAIM_DEADLINE = deadline
+    await bot.claim_scheduler.stop()
+    await bot.drain_outboxes(0)
+
+    await bot.close_session()
+    await upstream.stop()
+
+
+# --------- CLAIM LEDGER ----------
+class NoLedger(bot.ClaimLedger):
+    """
+    The old behaviour: every request claims its numbers again.
+    """
+
+    def begin(self, phone, claim_type):
+        return "run", None
+
+
+async def run_ledger(args):
+    """
+    `--bots` bots (at least 11) each get a claim for the same 20 numbers at
+    once, then claim them all again. Half the numbers activate on their 3rd
+    request, the rest never do. Counts /api/act calls with and without the
+    claim ledger.
+    """
+    calls = {}
+
+    def answer(request):
+        phone = request.query["number"]
+        calls[phone] = calls.get(phone, 0) + 1
+        return "Success" if int(phone) % 2 == 0 and calls[phone] >= 3 else "Please wait"
+
+    upstream = MockUpstream(latency=0.02, message=answer)
+    await upstream.start()
+    bot.API_BASE = upstream.base_url()
+    await bot.init_session()
+    bot.api_limiter = bot.TokenBucket(1e9, 10 ** 9)
+    bot.claim_slots = asyncio.Semaphore(1000)
+    bot.backoff_delay = lambda attempt, data=None, base=0, cap=0: 0.01
+    bots = max(args.bots, 11)
+    phones = [f"0300{n:07d}" for n in range(20)]
+
+    for name, ledger in (("no ledger", NoLedger), ("ledger", bot.ClaimLedger)):
+        calls.clear()
+        upstream.calls.clear()
+        bot.outboxes.clear()
+        bot.claim_ledger = ledger(bot.StateStore(bot.MemoryBackend()), "claim_ledger")
+        messages = [FakeMessage(n) for n in range(bots)]
+        begin = time.perf_counter()
+        for _ in range(2):
+            await asyncio.gather(*(bot.handle_claim_process(m, n, phones, "5gb", f"bot{n}")
+                                   for n, m in enumerate(messages)))
+        elapsed = time.perf_counter() - begin
+        await bot.drain_outboxes(30)
+        activated = sum(1 for m in messages for r in m.replies if "successfully activated" in r)
+        stats = bot.claim_ledger.stats
+        print(f"{name:<10} {upstream.calls.get('/api/act', 0):5d} /api/act calls   "
+              f"{activated:4d} activation replies   {elapsed:5.2f} s   "
+              f"started {stats['started']}, joined {stats['joined']}, skipped {stats['skipped']}")
+
+    await bot.drain_outboxes(0)
+    await bot.close_session()
+    await upstream.stop()
+
+
+SCENARIOS = {
+    "webhook": run_webhook,
+    "state": run_state,
+    "cache": run_cache,
+    "limits": run_limits,
+    "outbox": run_outbox,
+    "parallel": run_parallel,
+    "membership": run_membership,
+    "menus": run_menus,
+    "startup": run_startup,
+    "shards": run_shards,
+    "metrics": run_metrics,
+    "http": run_http,
+    "poller": run_poller,
+    "sessions": run_sessions,
+    "classifier": run_classifier,
+    "journeys": run_journeys,
+    "reload": run_reload,
+    "cancel": run_cancel,
+    "ledger": run_ledger,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--bots", type=int, default=len(bot.TOKENS))
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    asyncio.run(SCENARIOS[args.scenario](args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,39 @@
 import aiohttp
 import asyncio
+import bisect
+import functools
+import hashlib
+import heapq
+import hmac
+import itertools
 import json
 import logging
+import multiprocessing
+import os
+import random
+import re
+import signal
+import sqlite3
+import threading
+import time
+import uvicorn
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+from fastapi import FastAPI, Request, Response
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.error import Forbidden, BadRequest
+from telegram.error import Forbidden, BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-    MessageHandler, filters, ContextTypes
+    ChatMemberHandler, MessageHandler, TypeHandler, filters, ContextTypes
 )
 
+try:
+    # optional, faster JSON decoding for API responses
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 # Logging setup
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -87,46 +112,744 @@ TOKENS = {
         "channels": CHANNEL_3
     }
 }
+# --------- STATE STORE ----------
+# STATE_BACKEND=sqlite keeps user progress and number records across restarts.
+# Writes are buffered in memory and flushed in the background every
+# STATE_FLUSH_INTERVAL seconds, so handlers never wait on disk.
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_DB = os.getenv("STATE_DB", "bot_state.db")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "1.0"))
+# Sessions idle for SESSION_TTL seconds are dropped. SESSION_MAX (0 = no cap)
+# bounds how many are kept in memory, least recently used go first.
+SESSION_TTL = float(os.getenv("SESSION_TTL", "21600"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "0"))
+# users known to have no stored session, so their messages skip the backend
+SESSION_MISS_CACHE = int(os.getenv("SESSION_MISS_CACHE", "65536"))
+
+_DELETED = object()
+
+class MemoryBackend:
+    """
+    Default backend: nothing is stored, everything lives in the caches.
+    """
+    def load(self, table, key):
+        return _DELETED
+
+    def load_all(self, table):
+        return {}
+
+    def load_changed(self, table, since):
+        return {}
+
+    def write(self, changes):
+        pass
+
+    def close(self):
+        pass
+
+class SQLiteBackend:
+    """
+    Single-file key/value backend in WAL mode. Values are stored as JSON.
+    Point lookups from the event loop, table scans from threads and
+    flushes each use their own connection, so a lookup never waits for a
+    flush or a scan.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            "tbl TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "updated REAL NOT NULL DEFAULT 0, PRIMARY KEY (tbl, key))"
+        )
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(kv)")}
+        if "updated" not in columns:
+            # files written before rows were timestamped
+            self.db.execute("ALTER TABLE kv ADD COLUMN updated REAL NOT NULL DEFAULT 0")
+        self.db.execute("CREATE INDEX IF NOT EXISTS kv_updated ON kv (tbl, updated)")
+        self.db.commit()
+        self.read_lock = threading.Lock()
+        self.reader = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.scan_lock = threading.Lock()
+        self.scanner = sqlite3.connect(path, timeout=10, check_same_thread=False)
+
+    def load(self, table, key):
+        with self.read_lock:
+            row = self.reader.execute(
+                "SELECT value FROM kv WHERE tbl = ? AND key = ?", (table, json.dumps(key))
+            ).fetchone()
+        return json.loads(row[0]) if row else _DELETED
+
+    def load_all(self, table):
+        return self.load_changed(table, None)
+
+    def load_changed(self, table, since):
+        """
+        Rows written after `since` (a time.time() value), or all rows if it is None.
+        """
+        with self.scan_lock:
+            if since is None:
+                rows = self.scanner.execute("SELECT key, value FROM kv WHERE tbl = ?", (table,)).fetchall()
+            else:
+                rows = self.scanner.execute(
+                    "SELECT key, value FROM kv WHERE tbl = ? AND updated > ?", (table, since)
+                ).fetchall()
+        return {json.loads(k): json.loads(v) for k, v in rows}
+
+    def write(self, changes):
+        upserts = []
+        deletes = []
+        now = time.time()
+        for (table, key), value in changes.items():
+            if value is _DELETED:
+                deletes.append((table, json.dumps(key)))
+            else:
+                upserts.append((table, json.dumps(key), json.dumps(value, ensure_ascii=False), now))
+        with self.lock:
+            with self.db:
+                if upserts:
+                    self.db.executemany(
+                        "INSERT OR REPLACE INTO kv (tbl, key, value, updated) VALUES (?, ?, ?, ?)", upserts
+                    )
+                if deletes:
+                    self.db.executemany("DELETE FROM kv WHERE tbl = ? AND key = ?", deletes)
+
+    def close(self):
+        with self.read_lock:
+            self.reader.close()
+        with self.scan_lock:
+            self.scanner.close()
+        with self.lock:
+            self.db.close()
+
+class StateDict:
+    """
+    Dict-like view of one table. Keys are loaded lazily on first access.
+    """
+    def __init__(self, store, table):
+        self.store = store
+        self.table = table
+        self.cache = {}
+
+    def _load(self, key):
+        if not self.store.persistent:
+            return self.cache.get(key, _DELETED)
+        if key not in self.cache:
+            self.cache[key] = self.store.backend.load(self.table, key)
+        return self.cache[key]
+
+    def get(self, key, default=None):
+        value = self._load(key)
+        return default if value is _DELETED else value
+
+    def __getitem__(self, key):
+        value = self._load(key)
+        if value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.cache[key] = value
+        self.store.mark(self.table, key, value)
+
+    def __contains__(self, key):
+        return self._load(key) is not _DELETED
+
+    def pop(self, key, default=None):
+        value = self._load(key)
+        if value is _DELETED:
+            return default
+        if self.store.persistent:
+            self.cache[key] = _DELETED
+            self.store.mark(self.table, key, _DELETED)
+        else:
+            del self.cache[key]
+        return value
+
+    def __len__(self):
+        return sum(1 for v in self.cache.values() if v is not _DELETED)
+
+class StateSet:
+    """
+    Set-like view of one table, loaded in full on first use.
+    """
+    def __init__(self, store, table):
+        self.store = store
+        self.table = table
+        self.items = None
+
+    def _all(self):
+        if self.items is None:
+            self.items = set(self.store.backend.load_all(self.table))
+        return self.items
+
+    def add(self, item):
+        if item not in self._all():
+            self.items.add(item)
+            self.store.mark(self.table, item, True)
+
+    def discard(self, item):
+        if item in self._all():
+            self.items.discard(item)
+            self.store.mark(self.table, item, _DELETED)
+
+    def __contains__(self, item):
+        return item in self._all()
+
+    def merge(self, items):
+        """
+        Add items other processes wrote since the last sync. Removals are
+        not synced, nothing removes from these sets while sharded.
+        """
+        if self.items is not None:
+            self.items.update(items)
+
+    def __iter__(self):
+        return iter(self._all())
+
+    def __len__(self):
+        return len(self._all())
+
+# Conversation stages, stored as small ints instead of strings.
+STAGE_NONE = 0
+STAGE_AWAITING_PHONE_FOR_LOGIN = 1
+STAGE_AWAITING_OTP = 2
+STAGE_LOGGED_IN = 3
+STAGE_AWAITING_CLAIM_CHOICE = 4
+STAGE_AWAITING_PHONE_FOR_CLAIM = 5
+STAGE_NAMES = {
+    "awaiting_phone_for_login": STAGE_AWAITING_PHONE_FOR_LOGIN,
+    "awaiting_otp": STAGE_AWAITING_OTP,
+    "logged_in": STAGE_LOGGED_IN,
+    "awaiting_claim_choice": STAGE_AWAITING_CLAIM_CHOICE,
+    "awaiting_phone_for_claim": STAGE_AWAITING_PHONE_FOR_CLAIM,
+}
+
+class Session:
+    __slots__ = ("stage", "phone", "claim_type", "touched")
+
+    def __init__(self, stage=STAGE_NONE, phone=None, claim_type=None, touched=0.0):
+        self.stage = stage
+        self.phone = phone
+        self.claim_type = claim_type
+        self.touched = touched
+
+NO_SESSION = Session()
+
+class SessionStore:
+    """
+    Per-user conversation state kept in LRU order. Sessions idle longer than
+    `ttl` are dropped and, with a persistent backend, deleted from it too.
+    Past `max_sessions` the least recently used are dropped from memory only,
+    and a persistent backend loads them back on the next access.
+    """
+    def __init__(self, store, table, ttl=SESSION_TTL, max_sessions=SESSION_MAX):
+        self.store = store
+        self.table = table
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.missing = {}
+        self.evicted = 0
+
+    def _miss(self, user_id):
+        self.missing[user_id] = None
+        if len(self.missing) > SESSION_MISS_CACHE:
+            del self.missing[next(iter(self.missing))]
+
+    def _load(self, user_id):
+        if not self.store.persistent or user_id in self.missing:
+            return None
+        value = self.store.backend.load(self.table, user_id)
+        if value is _DELETED:
+            self._miss(user_id)
+            return None
+        if isinstance(value, dict):
+            # rows written before stages were numbered
+            value = [STAGE_NAMES.get(value.get("stage"), STAGE_NONE), value.get("phone"),
+                     value.get("claim_type"), time.time()]
+        session = Session(*value)
+        if time.time() - session.touched > self.ttl:
+            self.store.mark(self.table, user_id, _DELETED)
+            self._miss(user_id)
+            return None
+        return session
+
+    def get(self, user_id):
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = self._load(user_id)
+            if session is None:
+                return None
+            self.sessions[user_id] = session
+            self.sweep()
+        now = time.time()
+        if now - session.touched > self.ttl:
+            self.pop(user_id)
+            return None
+        session.touched = now
+        self.sessions.move_to_end(user_id)
+        return session
+
+    def set(self, user_id, stage, phone=None, claim_type=None):
+        session = Session(stage, phone, claim_type, time.time())
+        self.missing.pop(user_id, None)
+        self.sessions[user_id] = session
+        self.sessions.move_to_end(user_id)
+        self.store.mark(self.table, user_id, [stage, phone, claim_type, session.touched])
+        self.sweep(session.touched)
+        return session
+
+    def pop(self, user_id):
+        session = self.sessions.pop(user_id, None)
+        self.store.mark(self.table, user_id, _DELETED)
+        if self.store.persistent:
+            self._miss(user_id)
+        return session
+
+    def sweep(self, now=None):
+        """
+        Drop expired sessions from the old end, then trim to the cap.
+        """
+        now = time.time() if now is None else now
+        sessions = self.sessions
+        while sessions:
+            user_id, session = next(iter(sessions.items()))
+            if now - session.touched <= self.ttl:
+                break
+            self.pop(user_id)
+            self.evicted += 1
+        if self.max_sessions:
+            while len(sessions) > self.max_sessions:
+                sessions.popitem(last=False)
+                self.evicted += 1
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __len__(self):
+        return len(self.sessions)
+
+class StateStore:
+    def __init__(self, backend):
+        self.backend = backend
+        self.persistent = not isinstance(backend, MemoryBackend)
+        self.dirty = {}
+        self.flush_task = None
+
+    def mark(self, table, key, value):
+        if self.persistent:
+            self.dirty[(table, key)] = value
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        changes, self.dirty = self.dirty, {}
+        try:
+            await asyncio.to_thread(self.backend.write, changes)
+        except Exception as e:
+            logger.error(f"State flush failed: {e}")
+            # keep newer writes, retry the rest next time
+            changes.update(self.dirty)
+            self.dirty = changes
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            await self.flush()
+
+    def start(self):
+        if self.persistent and self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        self.backend.close()
+
+def make_state_backend():
+    if STATE_BACKEND == "sqlite":
+        return SQLiteBackend(STATE_DB)
+    return MemoryBackend()
+
 # Global variables
 
 
-user_states = {}
-user_cancel_flags = {}
-active_claim_tasks = {}
-blocked_numbers = set()
-activated_numbers = set()
+state_store = StateStore(make_state_backend())
+user_states = SessionStore(state_store, "user_states")
+settings = StateDict(state_store, "settings")
+blocked_numbers = StateSet(state_store, "blocked_numbers")
+activated_numbers = StateSet(state_store, "activated_numbers")
 request_count = 5
 requests_enabled = True
 session = None
 
+DEFAULT_API_BASE = os.getenv("API_BASE", "https://myapi1.vercel.app")
+API_BASE = DEFAULT_API_BASE
+
+# --------- HTTP CLIENT SETTINGS ----------
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "200"))
+HTTP_PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", "100"))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "8"))
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", "10"))
+http_stats = {"new": 0, "reused": 0}
+
+# --------- RESPONSE CACHE ----------
+# Seconds a successful response stays fresh, per endpoint path. 0 disables
+# caching but identical in-flight requests are still shared.
+CACHE_TTLS = {
+    "/api/log": float(os.getenv("CACHE_TTL_LOG", "1.0")),
+    "/api/act": float(os.getenv("CACHE_TTL_ACT", "0")),
+    "/api/acti": float(os.getenv("CACHE_TTL_ACTI", "0")),
+}
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+response_cache = OrderedDict()
+inflight_requests = {}
+inflight_waiters = {}
+cache_stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+# --------- UPSTREAM LIMITS ----------
+# One limiter and one breaker for the whole process, shared by every bot.
+API_RATE = float(os.getenv("API_RATE", "20"))
+API_BURST = int(os.getenv("API_BURST", "40"))
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "5"))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))
+LOGIN_MAX_ATTEMPTS = int(os.getenv("LOGIN_MAX_ATTEMPTS", "30"))
+
+# --------- UPSTREAM POLLER SETTINGS ----------
+# Login/OTP checks are re-polled by one scheduler instead of a task per user.
+POLL_TICK = float(os.getenv("POLL_TICK", "0.25"))
+POLL_BATCH = int(os.getenv("POLL_BATCH", str(HTTP_PER_HOST_LIMIT)))
+POLL_MAX_LIFETIME = float(os.getenv("POLL_MAX_LIFETIME", "180"))
+
+# --------- MEMBERSHIP CACHE ----------
+# Shared by all bots: membership is a property of the user and the channel.
+MEMBERSHIP_TTL = float(os.getenv("MEMBERSHIP_TTL", "300"))
+MEMBERSHIP_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_NEGATIVE_TTL", "15"))
+MEMBERSHIP_MAX_ENTRIES = 50000
+JOINED_STATUSES = ("member", "administrator", "creator")
+membership_cache = OrderedDict()
+membership_stats = {"hits": 0, "misses": 0}
+
+# --------- CLAIM SCHEDULER SETTINGS ----------
+CLAIM_WORKERS = int(os.getenv("CLAIM_WORKERS", "8"))
+# numbers of one claim processed at once, and the cap across all claims
+CLAIM_PARALLELISM = int(os.getenv("CLAIM_PARALLELISM", "3"))
+CLAIM_GLOBAL_PARALLELISM = int(os.getenv("CLAIM_GLOBAL_PARALLELISM", "32"))
+claim_slots = asyncio.Semaphore(CLAIM_GLOBAL_PARALLELISM)
+# a claim job is cancelled after CLAIM_DEADLINE seconds; on shutdown running
+# jobs and queued replies get SHUTDOWN_GRACE seconds before they are cancelled
+CLAIM_DEADLINE = float(os.getenv("CLAIM_DEADLINE", "600"))
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", "10"))
+# a number that was claimed is not claimed again for CLAIM_SUCCESS_COOLDOWN
+# seconds, one whose claim failed for CLAIM_FAILURE_COOLDOWN seconds
+CLAIM_SUCCESS_COOLDOWN = float(os.getenv("CLAIM_SUCCESS_COOLDOWN", "86400"))
+CLAIM_FAILURE_COOLDOWN = float(os.getenv("CLAIM_FAILURE_COOLDOWN", "60"))
+
+# --------- OUTBOUND MESSAGE SETTINGS ----------
+# Telegram allows roughly 30 messages/s per bot and 1 message/s per chat.
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "25"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "2.0"))
+PROGRESS_MAX_CHARS = 3500
+
+# --------- SHARDING SETTINGS ----------
+# BOT_WORKERS > 1 runs a supervisor that spreads the bots over that many
+# processes. BOT_SHARDS pins bots to workers, e.g. "BOT1,BOT2|BOT3".
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+BOT_SHARDS = os.getenv("BOT_SHARDS", "")
+SHARD_INDEX = os.getenv("SHARD_INDEX")
+# set in each shard: its own bots, every assigned bot and the shard count
+shard_keys = set()
+shard_assigned = set()
+shard_count = 1
+# each sync reads rows written since the last one, with some overlap for
+# writes that were still being committed
+SHARD_SYNC_OVERLAP = float(os.getenv("SHARD_SYNC_OVERLAP", "5"))
+shard_synced_at = None
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+update_stats = {"handled": 0}
+
+# --------- METRICS SETTINGS ----------
+# Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics, off unless
+# METRICS_PORT is set. Shards use METRICS_PORT + shard index.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# --------- STARTUP SETTINGS ----------
+STARTUP_CONCURRENCY = int(os.getenv("STARTUP_CONCURRENCY", "16"))
+STARTUP_RETRY_DELAY = float(os.getenv("STARTUP_RETRY_DELAY", "5"))
+STARTUP_RETRIES = int(os.getenv("STARTUP_RETRIES", "10"))
+startup_timings = {}
+bot_tasks = {}
+
+# --------- WEBHOOK SETTINGS ----------
+# BOT_MODE=webhook serves every bot from one HTTP server at /tg/<bot_key>.
+# With BOT_WORKERS > 1 the supervisor listens on WEBHOOK_PORT and forwards
+# each update to its shard on 127.0.0.1:WEBHOOK_PORT + 1 + shard index.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# chat_member updates are not sent unless asked for
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER]
+bot_apps = {}
+
+# --------- BOT CONFIG ----------
+# BOT_CONFIG replaces the built-in TOKENS with a JSON file (or inline JSON):
+#   {"api_base": "...", "channels": {"CHANNEL_1": [...]},
+#    "bots": {"BOT1": {"token": "...", "channels": "CHANNEL_1"}}}
+# A file is re-read when it changes, checked every CONFIG_POLL_INTERVAL seconds.
+BOT_CONFIG = os.getenv("BOT_CONFIG", "")
+CONFIG_POLL_INTERVAL = float(os.getenv("CONFIG_POLL_INTERVAL", "2.0"))
+config_stats = {"reloads": 0, "failed": 0, "last_reload": 0.0}
+
+def parse_bot_config(text):
+    """
+    Returns (tokens, api_base). A bot's "channels" is either the name of a
+    list under "channels" or an inline list.
+    """
+    config = json.loads(text)
+    channel_lists = config.get("channels", {})
+    tokens = {}
+    for key, cfg in config["bots"].items():
+        if not cfg.get("token"):
+            raise ValueError(f"Bot {key} has no token")
+        channels = cfg.get("channels", [])
+        if isinstance(channels, str):
+            channels = channel_lists[channels]
+        tokens[key] = {"token": cfg["token"], "channels": channels}
+        if cfg.get("base_url"):
+            tokens[key]["base_url"] = cfg["base_url"]
+    return tokens, config.get("api_base") or DEFAULT_API_BASE
+
+def config_is_file():
+    return bool(BOT_CONFIG) and not BOT_CONFIG.lstrip().startswith("{")
+
+def read_bot_config():
+    if not config_is_file():
+        return parse_bot_config(BOT_CONFIG)
+    with open(BOT_CONFIG, encoding="utf-8") as f:
+        return parse_bot_config(f.read())
+
+if BOT_CONFIG:
+    TOKENS, API_BASE = read_bot_config()
+
 # --------- SESSION MANAGEMENT ----------
+async def count_new_connection(session, context, params):
+    http_stats["new"] += 1
+
+async def count_reused_connection(session, context, params):
+    http_stats["reused"] += 1
+
 async def init_session():
+    """
+    Shared client for the claim API: pooled keep-alive connections with
+    per-host limits, cached DNS and separate connect/read timeouts.
+    """
     global session
-    session = aiohttp.ClientSession(headers={
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
-        "Accept": "application/json, text/plain, */*",
-        "Content-Type": "application/json"
-    })
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_create_end.append(count_new_connection)
+    trace.on_connection_reuseconn.append(count_reused_connection)
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_PER_HOST_LIMIT,
+        ttl_dns_cache=HTTP_DNS_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE
+    )
+    session = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(
+            total=HTTP_TOTAL_TIMEOUT,
+            connect=HTTP_CONNECT_TIMEOUT,
+            sock_read=HTTP_READ_TIMEOUT
+        ),
+        trace_configs=[trace],
+        headers={
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+            "Accept": "application/json, text/plain, */*",
+            "Content-Type": "application/json"
+        }
+    )
 
 async def close_session():
     global session
     if session and not session.closed:
         await session.close()
 
+# --------- METRICS ----------
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+class Histogram:
+    """
+    Fixed-bucket histogram. observe() is one bisect and three additions.
+    """
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        for labels, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {count}")
+        return lines
+
+upstream_seconds = Histogram("upstream_request_seconds", "Claim API request latency", ("endpoint",))
+upstream_errors = Counter("upstream_errors_total", "Failed claim API requests", ("endpoint", "error"))
+telegram_seconds = Histogram("telegram_send_seconds", "safe_reply/safe_edit latency", ("method",))
+telegram_errors = Counter("telegram_send_errors_total", "safe_reply/safe_edit errors", ("method", "error"))
+handler_seconds = Histogram("handler_seconds", "Update handler latency", ("update_type", "handler"))
+loop_lag_seconds = Histogram("event_loop_lag_seconds", "How late the event loop wakes a 1s timer",
+                             buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0))
+
+def update_type(update):
+    if getattr(update, "callback_query", None):
+        return "callback_query"
+    if getattr(update, "chat_member", None):
+        return "chat_member"
+    return "message"
+
+def instrumented(callback):
+    """
+    Wrap a handler callback to record its latency.
+    """
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, update_type(update), callback.__name__)
+    return wrapper
+
+async def loop_lag_monitor():
+    while True:
+        expected = time.perf_counter() + 1.0
+        await asyncio.sleep(1.0)
+        loop_lag_seconds.observe(max(0.0, time.perf_counter() - expected))
+
+def render_metrics():
+    lines = []
+    for metric in (upstream_seconds, upstream_errors, telegram_seconds, telegram_errors,
+                   handler_seconds, loop_lag_seconds):
+        lines.extend(metric.render())
+
+    # per-user tasks are named "<bot_key>:<kind>:<user_id>"
+    tasks = {}
+    for task in asyncio.all_tasks():
+        parts = task.get_name().split(":")
+        if len(parts) == 3:
+            tasks[(parts[0], parts[1])] = tasks.get((parts[0], parts[1]), 0) + 1
+    lines.append("# HELP active_tasks Running per-user tasks")
+    lines.append("# TYPE active_tasks gauge")
+    for (bot_key, kind), count in tasks.items():
+        lines.append(f'active_tasks{{bot="{bot_key}",kind="{kind}"}} {count}')
+
+    # *_total values only ever grow
+    values = {
+        "claim_queue_depth": claim_scheduler.depth(),
+        "claim_workers_busy": claim_scheduler.busy,
+        "claim_ledger_joined_total": claim_ledger.stats["joined"],
+        "claim_ledger_skipped_total": claim_ledger.stats["skipped"],
+        "login_checks_pending": len(upstream_poller.pending),
+        "config_reloads_total": config_stats["reloads"],
+        "config_reload_failures_total": config_stats["failed"],
+        "config_last_reload_seconds": config_stats["last_reload"],
+        "sessions": len(user_states),
+        "sessions_evicted_total": user_states.evicted,
+        "asyncio_tasks": len(asyncio.all_tasks()),
+        "bots_running": len(bot_apps),
+        "updates_handled_total": update_stats["handled"],
+        "http_connections_opened_total": http_stats["new"],
+        "http_connections_reused_total": http_stats["reused"],
+    }
+    for name, value in values.items():
+        lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def metrics_server():
+    api = FastAPI()
+
+    @api.get("/metrics")
+    async def metrics():
+        return Response(render_metrics(), media_type="text/plain; version=0.0.4")
+
+    port = METRICS_PORT + int(SHARD_INDEX or 0)
+    return uvicorn.Server(uvicorn.Config(api, host=METRICS_HOST, port=port, log_level="warning"))
+
+async def serve_metrics(server):
+    """
+    Run the metrics server. uvicorn exits the process if it cannot bind,
+    metrics are not worth that.
+    """
+    try:
+        await server.serve()
+    except (SystemExit, OSError) as e:
+        logger.warning(f"Metrics server on port {server.config.port} not started: {e!r}")
+
 # --------- SAFE MESSAGE SEND ----------
 async def safe_reply(msg, text, **kwargs):
     """
     Robust reply that works with both Message and CallbackQuery.
     """
+    started = time.perf_counter()
     try:
         # If it's a CallbackQuery, reply to the underlying message
         if hasattr(msg, "message") and hasattr(msg.message, "reply_text"):
-            await msg.message.reply_text(text, **kwargs)
+            return await msg.message.reply_text(text, **kwargs)
         elif hasattr(msg, "reply_text"):
-            await msg.reply_text(text, **kwargs)
+            return await msg.reply_text(text, **kwargs)
         else:
             logger.error("safe_reply: Unsupported object passed")
-    except Forbidden:
+    except Forbidden as e:
+        telegram_errors.inc("reply", type(e).__name__)
         # msg could be Message or CallbackQuery; get chat id safely if possible
         chat_id = None
         try:
@@ -135,12 +858,19 @@ async def safe_reply(msg, text, **kwargs):
             pass
         logger.warning(f"User blocked the bot: {chat_id}")
     except BadRequest as e:
+        telegram_errors.inc("reply", type(e).__name__)
         logger.error(f"BadRequest: {e}")
+    except Exception as e:
+        telegram_errors.inc("reply", type(e).__name__)
+        raise
+    finally:
+        telegram_seconds.observe(time.perf_counter() - started, "reply")
 
 async def safe_edit(msg, text, **kwargs):
     """
     Robust edit that works with both Message (edit_text) and CallbackQuery (edit_message_text).
     """
+    started = time.perf_counter()
     try:
         # CallbackQuery has edit_message_text
         if hasattr(msg, "edit_message_text"):
@@ -155,47 +885,714 @@ async def safe_edit(msg, text, **kwargs):
             await msg.message.edit_text(text, **kwargs)
             return
         logger.error("safe_edit: Unsupported object passed")
-    except Forbidden:
+    except Forbidden as e:
+        telegram_errors.inc("edit", type(e).__name__)
         logger.warning("User blocked the bot while editing message")
     except BadRequest as e:
+        telegram_errors.inc("edit", type(e).__name__)
         logger.error(f"BadRequest: {e}")
+    except Exception as e:
+        telegram_errors.inc("edit", type(e).__name__)
+        raise
+    finally:
+        telegram_seconds.observe(time.perf_counter() - started, "edit")
+
+# --------- RATE LIMIT / BACKOFF ----------
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` per second. A Retry-After from the API
+    pauses the whole bucket.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and fails fast until
+    `reset_timeout` has passed, then lets one probe request through.
+    """
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def retry_after(self):
+        """
+        Seconds until the next probe is allowed.
+        """
+        if self.opened_at is None:
+            return 0.0
+        remaining = self.opened_at + self.reset_timeout - time.monotonic()
+        if remaining <= 0:
+            # a probe is already in flight, give it time to report back
+            remaining = self.reset_timeout / 2
+        return remaining + random.uniform(0, 1)
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        now = time.monotonic()
+        if state == "half-open" and (self.probe_started is None or now - self.probe_started >= self.reset_timeout):
+            self.probe_started = now
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_started = None
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+api_limiter = TokenBucket(API_RATE, API_BURST)
+api_breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET)
+
+def backoff_delay(attempt, data=None, base=2.0, cap=30.0):
+    """
+    Exponential backoff with jitter, never shorter than a retry_after hint.
+    """
+    delay = random.uniform(base / 2, min(cap, base * 2 ** attempt))
+    if isinstance(data, dict) and data.get("retry_after"):
+        return max(delay, float(data["retry_after"]))
+    return delay
+
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
 
 # --------- API CALL ----------
-async def fetch_json(url):
+async def fetch_upstream(url):
     global session
     if session is None or session.closed:
         await init_session()
 
+    endpoint = urlsplit(url).path
+    if not api_breaker.allow():
+        upstream_errors.inc(endpoint, "circuit_open")
+        return {
+            "status": False,
+            "message": "Request failed: API unavailable, retrying later",
+            "retry_after": api_breaker.retry_after()
+        }
+
+    await api_limiter.acquire()
+    started = time.perf_counter()
     try:
-        async with session.get(url, timeout=10) as resp:
-            return await resp.json()
+        async with session.get(url) as resp:
+            if resp.status == 429 or resp.status >= 500:
+                retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                if retry_after:
+                    api_limiter.pause(retry_after)
+                api_breaker.record_failure()
+                upstream_errors.inc(endpoint, f"http_{resp.status}")
+                return {
+                    "status": False,
+                    "message": f"Request failed: HTTP {resp.status}",
+                    "retry_after": retry_after
+                }
+            data = await resp.json(loads=json_loads)
     except Exception as e:
+        api_breaker.record_failure()
+        upstream_errors.inc(endpoint, type(e).__name__)
         return {"status": False, "message": f"Request failed: {e}"}
+    finally:
+        upstream_seconds.observe(time.perf_counter() - started, endpoint)
+
+    api_breaker.record_success()
+    return data
+
+def cache_response(url, data):
+    ttl = CACHE_TTLS.get(urlsplit(url).path, 0)
+    if ttl <= 0 or not isinstance(data, dict) or str(data.get("message", "")).startswith("Request failed"):
+        return
+    response_cache[url] = (time.monotonic() + ttl, data)
+    response_cache.move_to_end(url)
+    while len(response_cache) > CACHE_MAX_ENTRIES:
+        response_cache.popitem(last=False)
+
+async def fetch_json(url):
+    """
+    Cached GET. Fresh responses are served from the LRU cache and identical
+    concurrent requests share a single upstream call.
+    """
+    entry = response_cache.get(url)
+    if entry:
+        if entry[0] > time.monotonic():
+            response_cache.move_to_end(url)
+            cache_stats["hits"] += 1
+            return entry[1]
+        del response_cache[url]
+
+    task = inflight_requests.get(url)
+    if task:
+        cache_stats["coalesced"] += 1
+        return await join_request(url, task)
+
+    cache_stats["misses"] += 1
+    task = asyncio.create_task(fetch_upstream(url))
+    inflight_requests[url] = task
+    task.add_done_callback(functools.partial(forget_request, url))
+    data = await join_request(url, task)
+    cache_response(url, data)
+    return data
+
+def forget_request(url, task):
+    if inflight_requests.get(url) is task:
+        del inflight_requests[url]
+
+async def join_request(url, task):
+    """
+    Wait for a shared upstream request. When the last caller waiting on it
+    is cancelled, the request is cancelled too and its connection freed.
+    """
+    inflight_waiters[url] = inflight_waiters.get(url, 0) + 1
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if inflight_waiters[url] == 1 and not task.done():
+            forget_request(url, task)
+            task.cancel()
+        raise
+    finally:
+        inflight_waiters[url] -= 1
+        if not inflight_waiters[url]:
+            del inflight_waiters[url]
+
+# --------- RESPONSE CLASSIFIER ----------
+OTP_SENT = "otp_sent"
+ALREADY_VERIFIED = "already_verified"
+VERIFIED = "verified"
+ACTIVATED = "activated"
+WRONG_OTP = "wrong_otp"
+RETRYABLE = "retryable"
+FATAL = "fatal"
+
+# One pass over the lowercased message. When several phrases match, the
+# group listed first wins, so "OTP successfully generated" is never read
+# as a claim success and our own "Request failed" messages are retried.
+# Rejections and negated successes rank above a success word. A negation
+# (not, no, never, cannot, -n't) anywhere before "success..." or
+# "activat..." in the same clause reads as a failure, as do
+# "unsuccessful", "success=false" and "failed".
+RESPONSE_MATCHER = re.compile(
+    r"(?P<retryable>^request failed)"
+    r"|(?P<wrong_otp>\b(?:wrong|invalid) otp\b)"
+    r"|(?P<otp_sent>\botp successfully generated\b)"
+    r"|(?P<already_verified>\bpin not allowed\b)"
+    r"|(?P<verified>\botp verified\b)"
+    r"|(?P<fatal>\binvalid number\b|\bnot a jazz number\b|\bnot eligible\b)"
+    r"|(?P<failed>\bunsuccessful(?:ly)?\b|\bsuccess\s*[=:]\s*false\b|\bfailed\b"
+    r"|(?:\b(?:not|no|never|cannot)\b|n['’]t\b)[^.,;:!?\n]*?\b(?:success|activat))"
+    r"|(?P<activated>\bsuccess(?:ful|fully)?\b|\bactivated\b)"
+)
+GROUP_PRIORITY = {name: rank for rank, name in enumerate(RESPONSE_MATCHER.groupindex)}
+# a failed attempt is retried like any other non-final reply
+GROUP_OUTCOME = {"failed": RETRYABLE}
+
+@functools.lru_cache(maxsize=1024)
+def classify_message(message):
+    best = None
+    rank = len(GROUP_PRIORITY)
+    for match in RESPONSE_MATCHER.finditer(message.lower()):
+        if GROUP_PRIORITY[match.lastgroup] < rank:
+            best = match.lastgroup
+            rank = GROUP_PRIORITY[best]
+    if best is None:
+        return RETRYABLE
+    return GROUP_OUTCOME.get(best, best)
+
+def classify_response(data):
+    """
+    Map an upstream JSON reply to one of the outcomes above. The API sends
+    a handful of fixed messages, so results are cached per message.
+    """
+    if not isinstance(data, dict) or data.get("retry_after"):
+        return RETRYABLE
+    outcome = classify_message(str(data.get("message") or ""))
+    if outcome == ACTIVATED and data.get("status") is False:
+        # a success word in a reply the API itself marks as failed
+        return RETRYABLE
+    return outcome
+
+# --------- UPSTREAM POLLER ----------
+# Outcomes that end a login or OTP check. FATAL always ends it.
+LOGIN_OUTCOMES = frozenset((OTP_SENT, ALREADY_VERIFIED))
+OTP_OUTCOMES = frozenset((VERIFIED, ACTIVATED, ALREADY_VERIFIED, WRONG_OTP))
+
+class PendingCheck:
+    __slots__ = ("key", "url", "outcomes", "future", "attempt", "deadline", "request")
+
+    def __init__(self, key, url, outcomes, future, deadline):
+        self.key = key
+        self.url = url
+        self.outcomes = outcomes
+        self.future = future
+        self.attempt = 0
+        self.deadline = deadline
+        self.request = None
+
+class UpstreamPoller:
+    """
+    Re-polls pending login/OTP checks from a single heap ordered by due
+    time. At most POLL_BATCH checks are in flight at once, so a burst of
+    logins queues here instead of timing out on the connection pool. Each
+    check's future resolves with the first outcome in its set, or FATAL,
+    or None once LOGIN_MAX_ATTEMPTS or POLL_MAX_LIFETIME is used up.
+    """
+    def __init__(self):
+        self.heap = []
+        self.pending = {}
+        self.counter = itertools.count()
+        self.wakeup = None
+        self.task = None
+        self.in_flight = 0
+        self.batches = set()
+        self.stopping = False
+
+    def has(self, key):
+        return key in self.pending
+
+    def submit(self, key, url, outcomes):
+        """
+        Start checking `url` for `key`, replacing any check it already has.
+        """
+        self.cancel(key)
+        future = asyncio.get_running_loop().create_future()
+        check = PendingCheck(key, url, outcomes, future, time.monotonic() + POLL_MAX_LIFETIME)
+        self.pending[key] = check
+        future.add_done_callback(lambda _: self.pending.pop(key, None) if self.pending.get(key) is check else None)
+        self.schedule(check, 0)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return future
+
+    def cancel(self, key):
+        check = self.pending.pop(key, None)
+        if check is None:
+            return False
+        # the heap entry is dropped lazily when it comes due
+        check.future.cancel()
+        if check.request and not check.request.done():
+            check.request.cancel()
+        return True
+
+    def schedule(self, check, delay):
+        heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), check))
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            batch = []
+            while self.heap and self.heap[0][0] <= now and self.in_flight + len(batch) < POLL_BATCH:
+                check = heapq.heappop(self.heap)[2]
+                if not check.future.done():
+                    batch.append(check)
+            if batch:
+                self.in_flight += len(batch)
+                task = asyncio.create_task(self.poll(batch))
+                self.batches.add(task)
+                task.add_done_callback(self.batches.discard)
+
+            if self.heap:
+                timeout = max(POLL_TICK, self.heap[0][0] - time.monotonic())
+            else:
+                timeout = None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def poll(self, batch):
+        for check in batch:
+            check.request = asyncio.ensure_future(fetch_json(check.url))
+        try:
+            results = await asyncio.gather(*(check.request for check in batch), return_exceptions=True)
+        finally:
+            self.in_flight -= len(batch)
+            self.wakeup.set()
+        now = time.monotonic()
+        for check, data in zip(batch, results):
+            check.request = None
+            if check.future.done():
+                continue
+            if isinstance(data, BaseException):
+                data = {"status": False, "message": f"Request failed: {data}"}
+            outcome = classify_response(data)
+            check.attempt += 1
+            if outcome in check.outcomes or outcome == FATAL:
+                check.future.set_result(outcome)
+            elif check.attempt >= LOGIN_MAX_ATTEMPTS or now >= check.deadline:
+                check.future.set_result(None)
+            else:
+                self.schedule(check, backoff_delay(check.attempt - 1, data))
+
+    def stop(self):
+        # the done-callbacks see this and skip their "stopped" reply
+        self.stopping = True
+        for key in list(self.pending):
+            self.cancel(key)
+        self.heap.clear()
+        for task in self.batches:
+            task.cancel()
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+upstream_poller = UpstreamPoller()
+
+# --------- OUTBOUND MESSAGES ----------
+def retry_after_seconds(error):
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+def chat_id_of(msg):
+    chat_id = getattr(msg, "chat_id", None)
+    if chat_id is None:
+        chat_id = getattr(getattr(msg, "chat", None), "id", None)
+    return chat_id
+
+class Outbox:
+    """
+    Per-bot send path that keeps under Telegram's flood limits. Every call
+    waits for a per-chat and a per-bot token and is retried after RetryAfter.
+    """
+    def __init__(self):
+        self.bucket = TokenBucket(OUTBOX_RATE, OUTBOX_RATE)
+        self.chats = OrderedDict()
+        self.pending = set()
+        self.sent = 0
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            bucket = self.chats[chat_id] = TokenBucket(OUTBOX_CHAT_RATE, 3)
+            if len(self.chats) > 10000:
+                self.chats.popitem(last=False)
+        self.chats.move_to_end(chat_id)
+        return bucket
+
+    async def call(self, chat_id, func, *args, **kwargs):
+        chat = self.chat_bucket(chat_id)
+        for _ in range(3):
+            await chat.acquire()
+            await self.bucket.acquire()
+            try:
+                self.sent += 1
+                return await func(*args, **kwargs)
+            except RetryAfter as e:
+                self.bucket.pause(retry_after_seconds(e))
+            except Exception as e:
+                logger.error(f"Outbound message to {chat_id} failed: {e}")
+                return None
+        logger.error(f"Giving up on message to {chat_id} after repeated flood control")
+
+    def post(self, chat_id, func, *args, **kwargs):
+        """
+        Fire-and-forget version of call().
+        """
+        task = asyncio.create_task(self.call(chat_id, func, *args, **kwargs))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        return task
+
+outboxes = {}
+
+def outbox_for(bot_key):
+    if bot_key not in outboxes:
+        outboxes[bot_key] = Outbox()
+    return outboxes[bot_key]
+
+async def drain_outboxes(timeout):
+    """
+    Wait up to `timeout` seconds for queued messages to go out, then cancel the rest.
+    """
+    pending = [task for outbox in outboxes.values() for task in outbox.pending]
+    if not pending:
+        return
+    if timeout > 0:
+        await asyncio.wait(pending, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+class ProgressMessage:
+    """
+    One message that collects progress lines and is edited in place at
+    most every PROGRESS_INTERVAL seconds.
+    """
+    def __init__(self, outbox, message, title):
+        self.outbox = outbox
+        self.message = message
+        self.chat_id = chat_id_of(message)
+        self.title = title
+        self.lines = []
+        self.sent = None
+        self.dirty = False
+        self.last_flush = 0.0
+        self.task = None
+        self.lock = asyncio.Lock()
+
+    def add(self, line):
+        self.lines.append(line)
+        self.dirty = True
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.flush_later())
+
+    def render(self):
+        text = "\n".join([self.title] + self.lines)
+        while len(text) > PROGRESS_MAX_CHARS and len(self.lines) > 1:
+            self.lines.pop(0)
+            text = "\n".join([self.title, "…"] + self.lines)
+        return text
+
+    async def flush_later(self):
+        delay = self.last_flush + PROGRESS_INTERVAL - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            self.last_flush = time.monotonic()
+            text = self.render()
+            if self.sent is None:
+                self.sent = await self.outbox.call(self.chat_id, safe_reply, self.message, text)
+            else:
+                await self.outbox.call(self.chat_id, safe_edit, self.sent, text)
+
+    def close(self):
+        """
+        Send the final state in the background.
+        """
+        # only cancel a pending timer, never an edit that is already being sent
+        if self.task and not self.task.done() and not self.lock.locked():
+            self.task.cancel()
+        task = asyncio.create_task(self.flush())
+        self.outbox.pending.add(task)
+        task.add_done_callback(self.outbox.pending.discard)
+
+# --------- CLAIM LEDGER ----------
+CLAIM_PENDING = "pending"
+CLAIM_SUCCEEDED = "succeeded"
+CLAIM_FAILED = "failed"
+# written when a claim is stopped, so other shards drop their pending copy
+CLAIM_ABANDONED = "abandoned"
+
+class ClaimLedger:
+    """
+    One record per (phone, claim type): [state, updated_at, requests used].
+    It is shared by every bot in the process and persisted with the state
+    store. Other shards' records arrive through merge() from the shard
+    sync loop, so begin() never reads the disk. A claim already running
+    here is joined instead of started again, and recent records are
+    honoured until their cooldown ends.
+    """
+    def __init__(self, store, table):
+        self.store = store
+        self.table = table
+        self.records = OrderedDict()
+        self.inflight = {}
+        self.stats = {"started": 0, "joined": 0, "skipped": 0}
+
+    def horizon(self, now):
+        # records older than this are past every cooldown
+        return now - max(CLAIM_SUCCESS_COOLDOWN, CLAIM_FAILURE_COOLDOWN, CLAIM_DEADLINE)
+
+    def write(self, key, state, requests=0):
+        now = time.time()
+        self.records[key] = [state, now, requests]
+        self.records.move_to_end(key)
+        self.store.mark(self.table, key, self.records[key])
+        horizon = self.horizon(now)
+        while next(iter(self.records.values()))[1] < horizon:
+            old, _ = self.records.popitem(last=False)
+            self.store.mark(self.table, old, _DELETED)
+
+    def merge(self, rows):
+        """
+        Take over records written by other processes. The newer of two
+        records for a key wins.
+        """
+        horizon = self.horizon(time.time())
+        for key, record in sorted(rows.items(), key=lambda item: item[1][1]):
+            local = self.records.get(key)
+            if record[1] < horizon or (local is not None and local[1] >= record[1]):
+                continue
+            self.records[key] = record
+            self.records.move_to_end(key)
+
+    def begin(self, phone, claim_type):
+        """
+        Returns ("run", None) if the caller should claim the number,
+        ("join", future) if the same claim is already running here, or the
+        recorded state and the seconds left on its cooldown.
+        """
+        key = f"{claim_type}:{phone}"
+        future = self.inflight.get(key)
+        if future is not None:
+            self.stats["joined"] += 1
+            return "join", future
+
+        record = self.records.get(key)
+        if record is not None:
+            state, updated_at, requests = record
+            cooldown = {
+                CLAIM_SUCCEEDED: CLAIM_SUCCESS_COOLDOWN,
+                CLAIM_FAILED: CLAIM_FAILURE_COOLDOWN,
+                CLAIM_PENDING: CLAIM_DEADLINE,
+                CLAIM_ABANDONED: 0,
+            }[state]
+            left = updated_at + cooldown - time.time()
+            if left > 0:
+                self.stats["skipped"] += 1
+                return state, left
+
+        self.inflight[key] = asyncio.get_running_loop().create_future()
+        self.write(key, CLAIM_PENDING)
+        self.stats["started"] += 1
+        return "run", None
+
+    def finish(self, phone, claim_type, succeeded, requests):
+        key = f"{claim_type}:{phone}"
+        self.write(key, CLAIM_SUCCEEDED if succeeded else CLAIM_FAILED, requests)
+        future = self.inflight.pop(key, None)
+        if future and not future.done():
+            future.set_result((succeeded, requests))
+
+    def abandon(self, phone, claim_type):
+        """
+        Release a claim that was cancelled, so the number can be claimed again.
+        """
+        key = f"{claim_type}:{phone}"
+        self.write(key, CLAIM_ABANDONED)
+        future = self.inflight.pop(key, None)
+        if future and not future.done():
+            future.set_result(None)
+
+claim_ledger = ClaimLedger(state_store, "claim_ledger")
+
+# --------- MENUS ----------
+# Keyboards never change, so they are built once and shared by every bot.
+JOINED_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Login", callback_data="login")],
+    [InlineKeyboardButton("Claim Your MB", callback_data="claim_menu")]
+])
+CLAIM_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Claim Weekly", callback_data="claim_5gb")],
+    [InlineKeyboardButton("Claim Monthly", callback_data="claim_100gb")]
+])
+CLAIM_MB_MENU = InlineKeyboardMarkup([[InlineKeyboardButton("📦 Claim Your MB", callback_data="claim_menu")]])
+channel_menus = {}
+
+def channel_menu(channels):
+    """
+    /start keyboard for a channel list. Bots with the same channels share one instance.
+    """
+    key = tuple((ch["name"], ch["link"]) for ch in channels)
+    menu = channel_menus.get(key)
+    if menu is None:
+        channel_buttons = []
+        for i in range(0, len(channels), 2):
+            row = [InlineKeyboardButton(ch["name"], url=ch["link"]) for ch in channels[i:i+2]]
+            channel_buttons.append(row)
+        channel_buttons.append([InlineKeyboardButton("I have joined", callback_data="joined")])
+        menu = channel_menus[key] = InlineKeyboardMarkup(channel_buttons)
+    return menu
 
 # --------- COMMAND HANDLERS ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    channels = getattr(context.application, "bot_channels", [])
-    channel_buttons = []
-    for i in range(0, len(channels), 2):
-        row = [InlineKeyboardButton(ch["name"], url=ch["link"]) for ch in channels[i:i+2]]
-        channel_buttons.append(row)
-
-    channel_buttons.append([InlineKeyboardButton("I have joined", callback_data="joined")])
+    menu = getattr(context.application, "start_menu", None)
+    if menu is None:
+        menu = channel_menu(getattr(context.application, "bot_channels", []))
     await safe_reply(
         update.message,
         "Welcome! Please join the channels below and then press 'I have joined':",
-        reply_markup=InlineKeyboardMarkup(channel_buttons)
+        reply_markup=menu
     )
 
+def cache_membership(channel_id, user_id, joined):
+    ttl = MEMBERSHIP_TTL if joined else MEMBERSHIP_NEGATIVE_TTL
+    key = (str(channel_id), user_id)
+    if ttl <= 0:
+        membership_cache.pop(key, None)
+        return
+    membership_cache[key] = (time.monotonic() + ttl, joined)
+    membership_cache.move_to_end(key)
+    if len(membership_cache) > MEMBERSHIP_MAX_ENTRIES:
+        membership_cache.popitem(last=False)
+
 async def check_membership(user_id, channel_id, context):
     if not channel_id:
         return True
+    entry = membership_cache.get((str(channel_id), user_id))
+    if entry and entry[0] > time.monotonic():
+        membership_stats["hits"] += 1
+        return entry[1]
+
+    membership_stats["misses"] += 1
     try:
         member = await context.bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-        return member.status in ["member", "administrator", "creator"]
     except Exception as e:
         logger.error(f"Error checking membership: {e}")
         return False
+    joined = member.status in JOINED_STATUSES
+    cache_membership(channel_id, user_id, joined)
+    return joined
+
+async def member_update_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Keeps the membership cache current when the bot sees a join or leave.
+    """
+    change = update.chat_member
+    if change:
+        joined = change.new_chat_member.status in JOINED_STATUSES
+        cache_membership(change.chat.id, change.new_chat_member.user.id, joined)
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     channels = getattr(context.application, "bot_channels", [])  # ← یہ نئی لائن
@@ -209,46 +1606,40 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if query.data == "joined":
         # Check if user has joined all channels
+        required = [ch for ch in channels if ch.get("id")]
+        results = await asyncio.gather(*(check_membership(user_id, ch["id"], context) for ch in required))
         all_joined = True
-        for ch in channels:
-            if ch.get("id"):
-                if not await check_membership(user_id, ch["id"], context):
-                    all_joined = False
-                    await safe_edit(query, f"Please join the channel: {ch['name']} first.")
-                    break
+        for ch, joined in zip(required, results):
+            if not joined:
+                all_joined = False
+                await safe_edit(query, f"Please join the channel: {ch['name']} first.")
+                break
 
         if all_joined:
-            keyboard = [
-                [InlineKeyboardButton("Login", callback_data="login")],
-                [InlineKeyboardButton("Claim Your MB", callback_data="claim_menu")]
-            ]
             await safe_edit(
                 query,
                 "You have joined all required channels. Please choose an option:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=JOINED_MENU
             )
 
     elif query.data == "login":
-        user_states[user_id] = {"stage": "awaiting_phone_for_login"}
+        user_states.set(user_id, STAGE_AWAITING_PHONE_FOR_LOGIN)
         await safe_edit(query, "Please send your phone number to receive OTP (e.g., 03012345678):")
 
     elif query.data == "claim_menu":
-        user_states[user_id] = {"stage": "awaiting_claim_choice"}
-        keyboard = [
-            [InlineKeyboardButton("Claim Weekly", callback_data="claim_5gb")],
-            [InlineKeyboardButton("Claim Monthly", callback_data="claim_100gb")]
-        ]
+        user_states.set(user_id, STAGE_AWAITING_CLAIM_CHOICE)
         await safe_edit(
             query,
             "Choose your claim option:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=CLAIM_MENU
         )
 
     elif query.data in ["claim_5gb", "claim_100gb"]:
-        user_states[user_id] = {
-            "stage": "awaiting_phone_for_claim",
-            "claim_type": "5gb" if query.data == "claim_5gb" else "100gb"
-        }
+        user_states.set(
+            user_id,
+            STAGE_AWAITING_PHONE_FOR_CLAIM,
+            claim_type="5gb" if query.data == "claim_5gb" else "100gb"
+        )
         await safe_edit(query, "Please send the phone number on which you want to activate your claim:")
 
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -257,83 +1648,33 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = update.message.from_user.id
     text = update.message.text.strip()
-    state = user_states.get(user_id, {})
+    state = user_states.get(user_id) or NO_SESSION
+    bot_key = getattr(getattr(context, "application", None), "bot_key", "default")
 
     if not requests_enabled:
         await safe_reply(update.message, "⚠️ Requests are currently disabled.")
         return
 
     # Handle different states
-    if state.get("stage") == "awaiting_phone_for_login":
+    if state.stage == STAGE_AWAITING_PHONE_FOR_LOGIN:
         phone = text
-        if user_id in active_claim_tasks:
+        if upstream_poller.has(user_id):
             await safe_reply(update.message, "⏳ Login process already running.")
             return
-        
-        async def login_task():
-            while True:
-                if user_cancel_flags.get(user_id, False):
-                    await safe_reply(update.message, "🛑 Process stopped.")
-                    user_cancel_flags[user_id] = False
-                    break
-                
-                data = await fetch_json(f"https://myapi1.vercel.app/api/log?num={phone}")
-                msg = (data.get("message") or "").lower()
-                
-                if "otp successfully generated" in msg:
-                    user_states[user_id] = {"stage": "awaiting_otp", "phone": phone}
-                    await safe_reply(update.message, "✅ OTP sent successfully, please enter the OTP.")
-                    break
-                elif "pin not allowed" in msg:
-                    user_states[user_id] = {"stage": "logged_in", "phone": phone}
-                    await safe_reply(
-                        update.message,
-                        "ℹ️ Number already verified.",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📦 Claim Your MB", callback_data="claim_menu")]])
-                    )
-                    break
-                else:
-                    await asyncio.sleep(2)
 
-        task = asyncio.create_task(login_task())
-        active_claim_tasks[user_id] = task
-        task.add_done_callback(lambda _: active_claim_tasks.pop(user_id, None))
+        future = upstream_poller.submit(user_id, f"{API_BASE}/api/log?num={phone}", LOGIN_OUTCOMES)
+        future.add_done_callback(functools.partial(login_done, update.message, user_id, phone, bot_key))
         await safe_reply(update.message, "🔄 Login process started!")
 
-    elif state.get("stage") == "awaiting_otp":
-        phone = state.get("phone")
+    elif state.stage == STAGE_AWAITING_OTP:
+        phone = state.phone
         otp = text
-        
-        async def otp_task():
-            while True:
-                if user_cancel_flags.get(user_id, False):
-                    await safe_reply(update.message, "🛑 Process stopped.")
-                    user_cancel_flags[user_id] = False
-                    break
-                
-                data = await fetch_json(f"https://myapi1.vercel.app/api/log?num={phone}&otp={otp}")
-                msg = (data.get("message") or "").lower()
-                
-                if "otp verified" in msg or "success" in msg:
-                    user_states[user_id] = {"stage": "logged_in", "phone": phone}
-                    await safe_reply(
-                        update.message,
-                        "✅ OTP verified successfully!",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📦 Claim Your MB", callback_data="claim_menu")]])
-                    )
-                    break
-                elif "wrong otp" in msg or "invalid otp" in msg:
-                    await safe_reply(update.message, "❌ Wrong OTP, please try again.")
-                    break
-                else:
-                    await asyncio.sleep(2)
-
-        task = asyncio.create_task(otp_task())
-        active_claim_tasks[user_id] = task
-        task.add_done_callback(lambda _: active_claim_tasks.pop(user_id, None))
+
+        future = upstream_poller.submit(user_id, f"{API_BASE}/api/log?num={phone}&otp={otp}", OTP_OUTCOMES)
+        future.add_done_callback(functools.partial(otp_done, update.message, user_id, phone, bot_key))
         await safe_reply(update.message, "🔄 Verifying OTP...")
 
-    elif state.get("stage") == "awaiting_phone_for_claim":
+    elif state.stage == STAGE_AWAITING_PHONE_FOR_CLAIM:
         phones = text.split()
         valid_phones = [p for p in phones if p.isdigit() and len(p) >= 10]
 
@@ -341,66 +1682,308 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await safe_reply(update.message, "⚠️ Please enter valid phone numbers")
             return
 
-        if user_id in active_claim_tasks:
+        if upstream_poller.has(user_id) or claim_scheduler.has_job(user_id):
             await safe_reply(update.message, "⚠️ Claim process already running")
             return
 
-        claim_type = state.get("claim_type", "5gb")
-        task = asyncio.create_task(handle_claim_process(update.message, user_id, valid_phones, claim_type))
-        active_claim_tasks[user_id] = task
-        task.add_done_callback(lambda _: active_claim_tasks.pop(user_id, None))
-        await safe_reply(update.message, "⏳ Claim process started!")
+        claim_type = state.claim_type or "5gb"
+        job = ClaimJob(bot_key, user_id, update.message, valid_phones, claim_type)
+        position = claim_scheduler.submit(job)
+        if position is None:
+            await safe_reply(update.message, "🔄 Bot is restarting, please send your numbers again in a minute.")
+        elif position:
+            await safe_reply(update.message, f"⏳ Claim queued, position {position}. It will start automatically.")
 
     else:
         await safe_reply(update.message, "ℹ️ Please use /start")
 
-async def handle_claim_process(message, user_id, phones, claim_type):
-    for phone in phones:
-        success_found = False  # ٹریک کرے کہ کہیں بھی کامیابی ملی یا نہیں
+def login_done(message, user_id, phone, bot_key, future):
+    """
+    Reply to the user once their login check resolves.
+    """
+    outbox = outbox_for(bot_key)
+    chat_id = chat_id_of(message)
+    if future.cancelled():
+        # a newer check for the same user replaces this one without a reply
+        if not upstream_poller.has(user_id) and not upstream_poller.stopping:
+            outbox.post(chat_id, safe_reply, message, "🛑 Process stopped.")
+        return
 
-        for i in range(1, request_count + 1):
-            if user_cancel_flags.get(user_id, False):
-                await safe_reply(message, "🛑 Process stopped by user.")
-                user_cancel_flags[user_id] = False
-                return
+    outcome = future.result()
+    if outcome == OTP_SENT:
+        user_states.set(user_id, STAGE_AWAITING_OTP, phone=phone)
+        outbox.post(chat_id, safe_reply, message, "✅ OTP sent successfully, please enter the OTP.")
+    elif outcome == ALREADY_VERIFIED:
+        user_states.set(user_id, STAGE_LOGGED_IN, phone=phone)
+        outbox.post(chat_id, safe_reply, message, "ℹ️ Number already verified.", reply_markup=CLAIM_MB_MENU)
+    elif outcome == FATAL:
+        outbox.post(chat_id, safe_reply, message, "❌ This number was rejected, please check it and try again.")
+    else:
+        outbox.post(chat_id, safe_reply, message, "⌛ No response for your number, please try again later.")
 
-            url = (
-                f"https://myapi1.vercel.app/api/act?number={phone}"
-                if claim_type == "5gb"
-                else f"https://myapi1.vercel.app/api/acti?number={phone}"
-            )
+def otp_done(message, user_id, phone, bot_key, future):
+    outbox = outbox_for(bot_key)
+    chat_id = chat_id_of(message)
+    if future.cancelled():
+        if not upstream_poller.has(user_id) and not upstream_poller.stopping:
+            outbox.post(chat_id, safe_reply, message, "🛑 Process stopped.")
+        return
 
-            try:
-                data = await fetch_json(url)
-                msg = (data.get("message") or "").lower()
+    outcome = future.result()
+    if outcome in (VERIFIED, ACTIVATED, ALREADY_VERIFIED):
+        user_states.set(user_id, STAGE_LOGGED_IN, phone=phone)
+        outbox.post(chat_id, safe_reply, message, "✅ OTP verified successfully!", reply_markup=CLAIM_MB_MENU)
+    elif outcome == WRONG_OTP:
+        outbox.post(chat_id, safe_reply, message, "❌ Wrong OTP, please try again.")
+    elif outcome == FATAL:
+        outbox.post(chat_id, safe_reply, message, "❌ This number was rejected, please check it and try again.")
+    else:
+        outbox.post(chat_id, safe_reply, message, "⌛ OTP could not be verified, please try again later.")
 
-                # نمبر + ریکویسٹ نمبر + صرف JSON رسپانس
-                formatted_response = f"[{phone}] Request {i}:\n{json.dumps(data, indent=2, ensure_ascii=False)}"
-                await safe_reply(message, formatted_response)
+async def handle_claim_process(message, user_id, phones, claim_type, bot_key="default"):
+    outbox = outbox_for(bot_key)
+    chat_id = chat_id_of(message)
+    progress = ProgressMessage(outbox, message, f"📋 Claim progress ({claim_type})")
+    user_slots = asyncio.Semaphore(CLAIM_PARALLELISM)
 
-                # --- کامیابی کا چیک ---
-                if (
-                    "success" in msg
-                    or "activated" in msg
-                    or "✅ status: your request has been successfully received".lower() in msg
-                ):
-                    activated_numbers.add(phone)
-                    success_found = True
-                    break  # باقی ریکویسٹ کی ضرورت نہیں
+    async def claim_number(phone):
+        success_found = False  # ٹریک کرے کہ کہیں بھی کامیابی ملی یا نہیں
+        url = (
+            f"{API_BASE}/api/act?number={phone}"
+            if claim_type == "5gb"
+            else f"{API_BASE}/api/acti?number={phone}"
+        )
 
-                await asyncio.sleep(0.5)
+        async with user_slots, claim_slots:
+            for i in range(1, request_count + 1):
+                try:
+                    data = await fetch_json(url)
+                    outcome = classify_response(data)
 
-            except Exception as e:
-                await safe_reply(message, f"[{phone}] Request {i}:\nError: {str(e)}")
-                await asyncio.sleep(0.5)
+                    # نمبر + ریکویسٹ نمبر + صرف JSON رسپانس
+                    progress.add(f"[{phone}] Request {i}: {json.dumps(data, ensure_ascii=False)}")
+
+                    # --- کامیابی کا چیک ---
+                    if outcome == ACTIVATED:
+                        activated_numbers.add(phone)
+                        success_found = True
+                        break  # باقی ریکویسٹ کی ضرورت نہیں
+                    if outcome == FATAL:
+                        break
+
+                    await asyncio.sleep(backoff_delay(i - 1, data, base=0.5, cap=8))
 
-        # ریکویسٹ ختم ہونے کے بعد رزلٹ میسج
+                except Exception as e:
+                    progress.add(f"[{phone}] Request {i}: Error: {str(e)}")
+                    await asyncio.sleep(backoff_delay(i - 1, base=0.5, cap=8))
+
+        # ہر نمبر کا رزلٹ ختم ہوتے ہی بھیج دو
         if success_found:
-            await safe_reply(message, f"✅ Package successfully activated on your number: {phone}")
+            outbox.post(chat_id, safe_reply, message, f"✅ Package successfully activated on your number: {phone}")
         else:
-            await safe_reply(message, f"❌ All attempts failed for {phone}, please try again.")
+            outbox.post(chat_id, safe_reply, message, f"❌ All attempts failed for {phone}, please try again.")
+        return success_found, i
 
-    user_states[user_id] = {"stage": "logged_in"}
+    async def run_claim(phone):
+        try:
+            succeeded, requests = await claim_number(phone)
+        except BaseException:
+            # stopped or crashed, let the next request claim it again
+            claim_ledger.abandon(phone, claim_type)
+            raise
+        claim_ledger.finish(phone, claim_type, succeeded, requests)
+
+    async def join_claim(phone, future):
+        # another user's claim for the same number is running, wait for it
+        result = await asyncio.shield(future)
+        if result is None:
+            outbox.post(chat_id, safe_reply, message, f"❌ Claim for {phone} was stopped, please try again.")
+            return
+        succeeded, requests = result
+        if succeeded:
+            outbox.post(chat_id, safe_reply, message, f"✅ Package successfully activated on your number: {phone}")
+        else:
+            outbox.post(chat_id, safe_reply, message, f"❌ All attempts failed for {phone}, please try again.")
+
+    claims = []
+    for phone in dict.fromkeys(phones):
+        status, detail = claim_ledger.begin(phone, claim_type)
+        if status == "run":
+            claims.append(run_claim(phone))
+        elif status == "join":
+            claims.append(join_claim(phone, detail))
+        elif status == CLAIM_SUCCEEDED:
+            outbox.post(chat_id, safe_reply, message, f"ℹ️ {phone} is already activated, skipped.")
+        elif status == CLAIM_FAILED:
+            outbox.post(chat_id, safe_reply, message, f"⏳ {phone} failed recently, try again in {detail:.0f}s.")
+        else:
+            outbox.post(chat_id, safe_reply, message, f"⏳ {phone} is already being claimed, skipped.")
+
+    try:
+        await asyncio.gather(*claims)
+    finally:
+        progress.close()
+
+    user_states.set(user_id, STAGE_LOGGED_IN)
+
+# --------- CLAIM SCHEDULER ----------
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+class ClaimJob:
+    def __init__(self, bot_key, user_id, message, phones, claim_type):
+        self.bot_key = bot_key
+        self.user_id = user_id
+        self.message = message
+        self.phones = phones
+        self.claim_type = claim_type
+        self.enqueued_at = time.monotonic()
+        self.task = None
+
+class ClaimScheduler:
+    """
+    Runs claim jobs on a fixed pool of workers. Each bot has its own FIFO
+    queue and workers take from the bots in round-robin order, so one busy
+    bot cannot starve the others. A user has at most one job at a time.
+    """
+    def __init__(self, workers):
+        self.size = workers
+        self.queues = OrderedDict()
+        self.jobs = {}
+        self.workers = []
+        self.busy = 0
+        self.wait_times = deque(maxlen=1000)
+        self.wakeup = None
+        self.stopping = False
+
+    def has_job(self, user_id):
+        return user_id in self.jobs
+
+    def depth(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def position(self, job):
+        """
+        Number of jobs that will start before this one, plus one.
+        """
+        queue = self.queues.get(job.bot_key)
+        if not queue or job not in queue:
+            return 0
+        index = queue.index(job)
+        ahead = sum(min(len(q), index + 1) for key, q in self.queues.items() if key != job.bot_key)
+        return ahead + index + 1
+
+    def submit(self, job):
+        """
+        Queue a job. Returns its queue position, 0 if a worker is free, or
+        None if the scheduler is stopping.
+        """
+        if self.stopping:
+            return None
+        self.ensure_workers()
+        self.jobs[job.user_id] = job
+        self.queues.setdefault(job.bot_key, deque()).append(job)
+        position = self.position(job)
+        self.wakeup.set()
+        return 0 if position <= self.size - self.busy else position
+
+    def cancel(self, user_id):
+        """
+        Drop a queued job or cancel a running one. Returns False if the user has none.
+        """
+        job = self.jobs.get(user_id)
+        if job is None:
+            return False
+        if job.task is None:
+            self.queues[job.bot_key].remove(job)
+            self.jobs.pop(user_id, None)
+        else:
+            job.task.cancel()
+        return True
+
+    def next_job(self):
+        for bot_key, queue in self.queues.items():
+            if queue:
+                job = queue.popleft()
+                # rotate so the next pick starts with the following bot
+                self.queues.move_to_end(bot_key)
+                return job
+        return None
+
+    def ensure_workers(self):
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        self.workers = [w for w in self.workers if not w.done()]
+        while len(self.workers) < self.size:
+            self.workers.append(asyncio.create_task(self.worker()))
+
+    async def run_job(self, job):
+        async with asyncio.timeout(CLAIM_DEADLINE):
+            await handle_claim_process(job.message, job.user_id, job.phones, job.claim_type, job.bot_key)
+
+    async def worker(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            self.busy += 1
+            self.wait_times.append(time.monotonic() - job.enqueued_at)
+            job.task = asyncio.create_task(self.run_job(job), name=f"{job.bot_key}:claim:{job.user_id}")
+            outbox = outbox_for(job.bot_key)
+            chat_id = chat_id_of(job.message)
+            try:
+                outbox.post(chat_id, safe_reply, job.message, "⏳ Claim process started!")
+                await asyncio.wait([job.task])
+                if job.task.cancelled():
+                    if not self.stopping:
+                        outbox.post(chat_id, safe_reply, job.message, "🛑 Process stopped by user.")
+                elif isinstance(job.task.exception(), TimeoutError):
+                    outbox.post(chat_id, safe_reply, job.message,
+                                "⌛ Claim took too long and was stopped, please try again.")
+                elif job.task.exception():
+                    logger.error(f"Claim job for {job.user_id} failed: {job.task.exception()}")
+            finally:
+                self.busy -= 1
+                self.jobs.pop(job.user_id, None)
+
+    def stats(self):
+        waits = list(self.wait_times)
+        return {
+            "queued": self.depth(),
+            "running": self.busy,
+            "workers": self.size,
+            "wait_p50": percentile(waits, 50),
+            "wait_p95": percentile(waits, 95),
+            "wait_p99": percentile(waits, 99),
+        }
+
+    async def stop(self, grace=0):
+        """
+        Drop queued jobs, give running ones up to `grace` seconds to finish,
+        then cancel the rest.
+        """
+        self.stopping = True
+        self.queues.clear()
+        running = [job.task for job in self.jobs.values() if job.task]
+        if running and grace > 0:
+            await asyncio.wait(running, timeout=grace)
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.wait(running)
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.jobs.clear()
+
+claim_scheduler = ClaimScheduler(CLAIM_WORKERS)
 
 # --------- ADMIN COMMANDS ----------
 async def set_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -410,6 +1993,7 @@ async def set_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if count < 1:
             raise ValueError
         request_count = count
+        settings["request_count"] = count
         await update.message.reply_text(f"✅ Request count set to {count}")
     except (IndexError, ValueError):
         await update.message.reply_text("⚠️ Usage: /set 5 (where 5 is the number of requests)")
@@ -417,78 +2001,575 @@ async def set_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def turn_on(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global requests_enabled
     requests_enabled = True
+    settings["requests_enabled"] = True
     await update.message.reply_text("✅ Requests enabled")
 
 async def turn_off(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global requests_enabled
     requests_enabled = False
+    settings["requests_enabled"] = False
     await update.message.reply_text("⛔ Requests disabled")
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    claims = claim_scheduler.stats()
     status_text = (
         f"📊 Bot Status\n"
         f"🔹 Requests: {'✅ On' if requests_enabled else '⛔ Off'}\n"
         f"🔹 Request count: {request_count}\n"
         f"🔹 Blocked numbers: {len(blocked_numbers)}\n"
         f"🔹 Activated numbers: {len(activated_numbers)}\n"
-        f"🔹 Active tasks: {len(active_claim_tasks)}"
+        f"🔹 Pending login/OTP checks: {len(upstream_poller.pending)}\n"
+        f"🔹 Sessions: {len(user_states)} ({user_states.evicted} evicted)\n"
+        f"🔹 API cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+        f"{cache_stats['coalesced']} coalesced\n"
+        f"🔹 API circuit: {api_breaker.state}\n"
+        f"🔹 API connections: {http_stats['new']} opened, {http_stats['reused']} reused\n"
+        f"🔹 Membership cache: {membership_stats['hits']} hits, {membership_stats['misses']} misses\n"
+        f"🔹 Claim ledger: {claim_ledger.stats['started']} started, "
+        f"{claim_ledger.stats['joined']} joined a running claim, {claim_ledger.stats['skipped']} skipped\n"
+        f"🔹 Claim queue: {claims['queued']} waiting, {claims['running']}/{claims['workers']} workers busy\n"
+        f"🔹 Queue wait p50/p95/p99: {claims['wait_p50']:.1f}s / {claims['wait_p95']:.1f}s / {claims['wait_p99']:.1f}s"
     )
+    if SHARD_INDEX is not None:
+        totals = await fleet_stats()
+        status_text += (
+            f"\n🔹 All shards ({totals['shards']}): {totals['bots']} bots, "
+            f"{totals['updates']} updates, {totals['active_tasks']} active tasks, "
+            f"{totals['claims_queued']} claims waiting, {totals['claims_running']} running, "
+            f"cache {totals['cache_hits']} hits / {totals['cache_misses']} misses, "
+            f"{totals['claims_joined']} claims joined / {totals['claims_skipped']} skipped by the ledger"
+        )
     await update.message.reply_text(status_text)
 
+def cancel_user(user_id):
+    """
+    Cancel the user's claim job and login/OTP check. In-flight API calls
+    are interrupted, not waited out.
+    """
+    stopped = claim_scheduler.cancel(user_id)
+    return upstream_poller.cancel(user_id) or stopped
+
 async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    user_cancel_flags[user_id] = True
+    cancel_user(user_id)
     await update.message.reply_text("🛑 Process stopped")
 
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    update_stats["handled"] += 1
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Update {update} caused error {context.error}", exc_info=context.error)
 
+# --------- WEBHOOK SERVER ----------
+def webhook_secret(bot_key, token):
+    """
+    Per-bot secret for X-Telegram-Bot-Api-Secret-Token.
+    """
+    key = (WEBHOOK_SECRET or token).encode()
+    return hmac.new(key, bot_key.encode(), hashlib.sha256).hexdigest()
+
+def create_webhook_app():
+    api = FastAPI()
+
+    @api.post("/tg/{bot_key}")
+    async def telegram_webhook(bot_key: str, request: Request):
+        app = bot_apps.get(bot_key)
+        if app is None:
+            return Response(status_code=404)
+
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret.encode(), app.webhook_secret.encode()):
+            return Response(status_code=403)
+
+        try:
+            update = Update.de_json(await request.json(), app.bot)
+        except Exception as e:
+            logger.error(f"Bad webhook payload for {bot_key}: {e}")
+            return Response(status_code=400)
+
+        await app.update_queue.put(update)
+        return Response(status_code=200)
+
+    return api
+
+def webhook_server():
+    config = uvicorn.Config(create_webhook_app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT, log_level="warning")
+    return uvicorn.Server(config)
+
+# --------- SHARDING ----------
+def local_stats():
+    claims = claim_scheduler.stats()
+    return {
+        "bots": len(bot_apps),
+        "updates": update_stats["handled"],
+        "active_tasks": len(upstream_poller.pending) + len(claim_scheduler.jobs),
+        "claims_queued": claims["queued"],
+        "claims_running": claims["running"],
+        "cache_hits": cache_stats["hits"],
+        "cache_misses": cache_stats["misses"],
+        "claims_joined": claim_ledger.stats["joined"],
+        "claims_skipped": claim_ledger.stats["skipped"],
+        "updated_at": time.time(),
+    }
+
+async def fleet_stats():
+    """
+    Sum of the counters every shard publishes to the shared store.
+    """
+    rows = await asyncio.to_thread(state_store.backend.load_all, "shard_stats")
+    rows[SHARD_INDEX] = local_stats()
+    fresh = [r for r in rows.values() if time.time() - r.get("updated_at", 0) < 30]
+    totals = {key: sum(r.get(key, 0) for r in fresh) for key in local_stats() if key != "updated_at"}
+    totals["shards"] = len(fresh)
+    return totals
+
+def load_shared_tables(since):
+    backend = state_store.backend
+    tables = ("activated_numbers", "blocked_numbers", "settings", "claim_ledger")
+    return {table: backend.load_changed(table, since) for table in tables}
+
+def apply_settings(stored):
+    """
+    Take over /on, /off and /set values saved in the state store.
+    """
+    global requests_enabled, request_count
+    settings.cache.update(stored)
+    requests_enabled = stored.get("requests_enabled", requests_enabled)
+    request_count = stored.get("request_count", request_count)
+
+async def load_saved_state():
+    """
+    Settings and recent claims from the last run, read once at startup.
+    """
+    if state_store.persistent:
+        apply_settings(await asyncio.to_thread(state_store.backend.load_all, "settings"))
+        claim_ledger.merge(await asyncio.to_thread(state_store.backend.load_all, "claim_ledger"))
+
+async def sync_shared_state():
+    """
+    Publish this shard's changes and counters, then pick up the rows the
+    other shards changed since the last sync.
+    """
+    global shard_synced_at
+    await state_store.flush()
+    await asyncio.to_thread(state_store.backend.write, {("shard_stats", SHARD_INDEX): local_stats()})
+    started = time.time()
+    since = None if shard_synced_at is None else shard_synced_at - SHARD_SYNC_OVERLAP
+    tables = await asyncio.to_thread(load_shared_tables, since)
+    shard_synced_at = started
+    activated_numbers.merge(tables["activated_numbers"])
+    blocked_numbers.merge(tables["blocked_numbers"])
+    claim_ledger.merge(tables["claim_ledger"])
+    apply_settings(tables["settings"])
+
+async def shard_sync_loop():
+    while True:
+        try:
+            await sync_shared_state()
+        except Exception as e:
+            logger.error(f"Shard sync failed: {e}")
+        await asyncio.sleep(STATE_FLUSH_INTERVAL)
+
+def shard_assignment(tokens, workers):
+    if BOT_SHARDS:
+        shards = [[key.strip() for key in group.split(",") if key.strip()] for group in BOT_SHARDS.split("|")]
+    else:
+        shards = [[] for _ in range(workers)]
+        for i, key in enumerate(tokens):
+            shards[i % workers].append(key)
+    return [shard for shard in shards if shard]
+
+def hashed_shard(key, count):
+    return int(hashlib.md5(key.encode()).hexdigest(), 16) % count
+
+def shard_of(key, shards):
+    """
+    Index of the shard that runs `key`, the same choice owns_bot() makes.
+    """
+    for index, keys in enumerate(shards):
+        if key in keys:
+            return index
+    return hashed_shard(key, len(shards))
+
+def cancel_on_sigterm():
+    """
+    Make SIGTERM cancel the current task, so its cleanup runs.
+    """
+    task = asyncio.current_task()
+
+    def stop():
+        # uvicorn re-raises SIGTERM after its own shutdown, cancel only once
+        if not task.cancelling():
+            task.cancel()
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop)
+
+def run_shard(index, bot_keys, shards=None):
+    """
+    Worker process entry point.
+    """
+    global SHARD_INDEX, WEBHOOK_HOST, WEBHOOK_PORT, shard_keys, shard_assigned, shard_count
+    SHARD_INDEX = str(index)
+    shards = shards or [bot_keys]
+    shard_keys = set(bot_keys)
+    shard_assigned = {key for shard in shards for key in shard}
+    shard_count = len(shards)
+    # each shard serves its own bots' webhooks, the supervisor forwards to it
+    WEBHOOK_HOST = "127.0.0.1"
+    WEBHOOK_PORT += 1 + index
+
+    async def runner():
+        cancel_on_sigterm()
+        await main(bot_keys)
+
+    try:
+        asyncio.run(runner())
+    except KeyboardInterrupt:
+        pass
+
+class ShardSupervisor:
+    """
+    Keeps one worker process per shard alive, restarting crashed workers
+    with a growing delay if they keep dying.
+    """
+    def __init__(self, shards):
+        self.shards = shards
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = {}
+        self.started_at = {}
+        self.restarts = {}
+        self.restart_at = {}
+
+    def spawn(self, index):
+        process = self.context.Process(target=run_shard, args=(index, self.shards[index], self.shards), name=f"shard-{index}")
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        logger.info(f"Shard {index} (pid {process.pid}) serving {', '.join(self.shards[index])}")
+
+    def start(self):
+        for index in range(len(self.shards)):
+            self.spawn(index)
+
+    def check(self):
+        now = time.monotonic()
+        for index, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            if index not in self.restart_at:
+                if now - self.started_at[index] > 60:
+                    self.restarts[index] = 0
+                self.restarts[index] = self.restarts.get(index, 0) + 1
+                delay = min(30, 2 ** (self.restarts[index] - 1))
+                self.restart_at[index] = now + delay
+                logger.error(f"Shard {index} exited with code {process.exitcode}, restarting in {delay}s")
+            elif now >= self.restart_at[index]:
+                del self.restart_at[index]
+                self.spawn(index)
+
+    def forward_server(self, client):
+        """
+        The public webhook listener: passes /tg/<bot_key> on to the shard
+        that runs the bot and returns its status code.
+        """
+        api = FastAPI()
+
+        @api.post("/tg/{bot_key}")
+        async def forward_webhook(bot_key: str, request: Request):
+            port = WEBHOOK_PORT + 1 + shard_of(bot_key, self.shards)
+            headers = {
+                "Content-Type": "application/json",
+                "X-Telegram-Bot-Api-Secret-Token": request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""),
+            }
+            try:
+                async with client.post(f"http://127.0.0.1:{port}/tg/{bot_key}",
+                                       data=await request.body(), headers=headers) as resp:
+                    return Response(status_code=resp.status)
+            except aiohttp.ClientError as e:
+                # shard restarting, Telegram retries on 5xx
+                logger.error(f"Forwarding update for {bot_key} failed: {e}")
+                return Response(status_code=503)
+
+        config = uvicorn.Config(api, host=WEBHOOK_HOST, port=WEBHOOK_PORT, log_level="warning")
+        return uvicorn.Server(config)
+
+    def stop(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join(10)
+            if process.is_alive():
+                process.kill()
+
+def supervise():
+    if STATE_BACKEND != "sqlite":
+        # shards share activated numbers and settings through the state file
+        logger.warning("BOT_WORKERS > 1 needs a shared store, using STATE_BACKEND=sqlite")
+        os.environ["STATE_BACKEND"] = "sqlite"
+
+    supervisor = ShardSupervisor(shard_assignment(TOKENS, BOT_WORKERS))
+    supervisor.start()
+    try:
+        asyncio.run(supervise_loop(supervisor))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logger.info("Supervisor stopping shards...")
+    finally:
+        supervisor.stop()
+
+async def supervise_loop(supervisor):
+    # SIGTERM (docker stop, systemd) ends the loop, then supervise() stops the shards
+    cancel_on_sigterm()
+    server = None
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as client:
+        if BOT_MODE == "webhook":
+            server = supervisor.forward_server(client)
+            server_task = asyncio.create_task(server.serve())
+        try:
+            while True:
+                await asyncio.sleep(1)
+                supervisor.check()
+        finally:
+            if server:
+                server.should_exit = True
+                await asyncio.wait([server_task], timeout=10)
+
 # --------- MAIN FUNCTION ----------
-async def run_bot(bot_key, token, channels):
-    app = ApplicationBuilder().token(token).build()
+async def run_bot(bot_key, token, channels, base_url=None):
+    builder = ApplicationBuilder().token(token)
+    if base_url:
+        builder = builder.base_url(base_url)
+    app = builder.build()
     app.bot_channels = channels
+    app.start_menu = channel_menu(channels)
+    app.bot_key = bot_key
+    app.webhook_secret = webhook_secret(bot_key, token)
 
     # Add handlers
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CallbackQueryHandler(button_handler))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-    app.add_handler(CommandHandler("set", set_command))
-    app.add_handler(CommandHandler("on", turn_on))
-    app.add_handler(CommandHandler("off", turn_off))
-    app.add_handler(CommandHandler("status", status_command))
-    app.add_handler(CommandHandler("stop", stop_command))
+    app.add_handler(TypeHandler(Update, count_update), group=-1)
+    app.add_handler(CommandHandler("start", instrumented(start)))
+    app.add_handler(CallbackQueryHandler(instrumented(button_handler)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(message_handler)))
+    app.add_handler(CommandHandler("set", instrumented(set_command)))
+    app.add_handler(CommandHandler("on", instrumented(turn_on)))
+    app.add_handler(CommandHandler("off", instrumented(turn_off)))
+    app.add_handler(CommandHandler("status", instrumented(status_command)))
+    app.add_handler(CommandHandler("stop", instrumented(stop_command)))
+    app.add_handler(ChatMemberHandler(instrumented(member_update_handler), ChatMemberHandler.CHAT_MEMBER))
     app.add_error_handler(error_handler)
-    
-    await app.initialize()
-    await app.start()
 
-    # ✅ Start polling so that commands like /start actually work
-    await app.updater.start_polling(drop_pending_updates=True)
+    try:
+        await app.initialize()
+        await app.start()
+
+        if BOT_MODE == "webhook":
+            # 🌐 Updates arrive through the shared webhook server
+            await app.bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}/tg/{bot_key}",
+                secret_token=app.webhook_secret,
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=True
+            )
+        else:
+            # ✅ Start polling so that commands like /start actually work.
+            # This also removes any old webhook and its pending updates.
+            await app.updater.start_polling(allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True)
+    except Exception:
+        await stop_bot(app)
+        raise
+
+    bot_apps[bot_key] = app
 
     logger.info(f"Bot with token {token[-5:]} started successfully")
     return app
 
-async def main():
+async def stop_bot(app):
+    bot_apps.pop(getattr(app, "bot_key", None), None)
+    try:
+        if app.updater and app.updater.running:
+            await app.updater.stop()
+    except Exception as e:
+        logger.error(f"Error stopping updater: {e}")
+    try:
+        if app.running:
+            await app.stop()
+    except Exception as e:
+        logger.error(f"Error stopping bot: {e}")
+    try:
+        await app.shutdown()
+    except Exception as e:
+        logger.error(f"Error during shutdown: {e}")
+
+async def start_bot_with_retry(bot_key, cfg, limit, bots, first_attempt):
+    """
+    Start one bot, retrying with backoff. first_attempt is set after the
+    first try so startup can go on while retries continue in the background.
+    """
+    for attempt in range(STARTUP_RETRIES + 1):
+        began = time.monotonic()
+        try:
+            async with limit:
+                app = await run_bot(bot_key, cfg["token"], cfg["channels"], cfg.get("base_url") or BOT_API_URL)
+        except Exception as e:
+            logger.error(f"Failed to start bot {bot_key} (attempt {attempt + 1}): {e}")
+            first_attempt.set()
+            await asyncio.sleep(backoff_delay(attempt, base=STARTUP_RETRY_DELAY, cap=300))
+            continue
+
+        startup_timings[bot_key] = time.monotonic() - began
+        bots.append(app)
+        first_attempt.set()
+        logger.info(f"Bot started: {bot_key} in {startup_timings[bot_key]:.2f}s")
+        return app
+
+    logger.error(f"Giving up on bot {bot_key} after {STARTUP_RETRIES + 1} attempts")
+
+async def start_bots(tokens, bots):
+    """
+    Start all bots concurrently, at most STARTUP_CONCURRENCY at a time.
+    Returns once every bot has had its first attempt; the returned tasks
+    keep retrying the ones that failed.
+    """
+    limit = asyncio.Semaphore(STARTUP_CONCURRENCY)
+    began = time.monotonic()
+    events = {key: asyncio.Event() for key in tokens}
+    tasks = []
+    for key, cfg in tokens.items():
+        task = asyncio.create_task(start_bot_with_retry(key, cfg, limit, bots, events[key]))
+        bot_tasks[key] = task
+        tasks.append(task)
+    await asyncio.gather(*(event.wait() for event in events.values()))
+
+    timings = ", ".join(f"{key} {startup_timings[key]:.2f}s" for key in tokens if key in startup_timings)
+    logger.info(f"{len(bots)}/{len(tokens)} bots up in {time.monotonic() - began:.2f}s ({timings})")
+    return tasks
+
+# --------- CONFIG RELOAD ----------
+def owns_bot(key):
+    """
+    Whether this process runs `key`. A shard keeps the bots it was given,
+    bots added later go to the shard picked by a hash of their key.
+    """
+    if SHARD_INDEX is None or key in shard_keys:
+        return True
+    if key in shard_assigned:
+        return False
+    return hashed_shard(key, shard_count) == int(SHARD_INDEX)
+
+async def stop_bot_key(key, bots):
+    task = bot_tasks.pop(key, None)
+    if task and not task.done():
+        task.cancel()
+    app = bot_apps.get(key)
+    if app:
+        await stop_bot(app)
+        if app in bots:
+            bots.remove(app)
+
+async def reload_bots(tokens, api_base, bots):
+    """
+    Bring the running fleet in line with a new config. Bots whose token or
+    Bot API URL changed are restarted, bots with only new channels get
+    their channels and menu swapped in place, the rest are not touched.
+    """
+    global TOKENS, API_BASE
+    began = time.perf_counter()
+    if api_base != API_BASE:
+        API_BASE = api_base
+        response_cache.clear()
+
+    old = TOKENS
+    wanted = {key: cfg for key, cfg in tokens.items() if owns_bot(key)}
+    stop, start, swapped = [], {}, []
+    for key in set(old) | set(wanted):
+        cfg = wanted.get(key)
+        prev = old.get(key)
+        known = key in bot_apps or key in bot_tasks
+        if cfg is None:
+            if known:
+                stop.append(key)
+            continue
+        # bots that are down or still retrying get a fresh start as well
+        same_bot = prev is not None and key in bot_apps and (
+            (cfg["token"], cfg.get("base_url")) == (prev["token"], prev.get("base_url"))
+        )
+        if not same_bot:
+            if known:
+                stop.append(key)
+            start[key] = cfg
+        elif cfg["channels"] != prev["channels"]:
+            app = bot_apps[key]
+            # both in one step, handlers never see new channels with the old menu
+            app.bot_channels, app.start_menu = cfg["channels"], channel_menu(cfg["channels"])
+            swapped.append(key)
+
+    TOKENS = tokens
+    await asyncio.gather(*(stop_bot_key(key, bots) for key in stop))
+    if start:
+        await start_bots(start, bots)
+
+    config_stats["reloads"] += 1
+    config_stats["last_reload"] = time.perf_counter() - began
+    logger.info(
+        f"Config reloaded in {config_stats['last_reload'] * 1000:.1f} ms: "
+        f"started {sorted(start) or '-'}, stopped {sorted(set(stop) - set(start)) or '-'}, "
+        f"new channels {sorted(swapped) or '-'}"
+    )
+
+async def config_watch_loop(bots):
+    """
+    Re-read BOT_CONFIG whenever the file changes. A config that fails to
+    parse is logged and the running one is kept.
+    """
+    try:
+        seen = os.stat(BOT_CONFIG).st_mtime_ns
+    except OSError:
+        seen = None
+    while True:
+        await asyncio.sleep(CONFIG_POLL_INTERVAL)
+        try:
+            mtime = os.stat(BOT_CONFIG).st_mtime_ns
+        except OSError:
+            continue
+        if mtime == seen:
+            continue
+        seen = mtime
+        try:
+            tokens, api_base = await asyncio.to_thread(read_bot_config)
+        except Exception as e:
+            config_stats["failed"] += 1
+            logger.error(f"Config reload failed, keeping the running config: {e}")
+            continue
+        await reload_bots(tokens, api_base, bots)
+
+async def main(bot_keys=None):
     await init_session()
+    state_store.start()
+    # /on, /off, /set and claim cooldowns survive restarts, sharded or not
+    await load_saved_state()
+    # a shard also picks up bots added to the config since the supervisor started
+    tokens = {key: cfg for key, cfg in TOKENS.items() if owns_bot(key)} if bot_keys else TOKENS
     bots = []
+    startup_tasks = []
+    servers = []
+    server_tasks = []
+    background = [asyncio.create_task(loop_lag_monitor())]
     try:
-        for bot_key, cfg in TOKENS.items():
-            try:
-                # ⏳ پرانے instance کو بند ہونے کا تھوڑا وقت دو
-                await asyncio.sleep(3)
-                
-                # 🚀 Bot start
-                bot = await run_bot(bot_key, cfg["token"], cfg["channels"])
-                
-                # 🧹 پچھلا webhook + pending updates صاف کرو
-                await bot.bot.delete_webhook(drop_pending_updates=True)
-                
-                bots.append(bot)
-                logger.info(f"Bot started: {bot_key}")
+        if SHARD_INDEX is not None:
+            background.append(asyncio.create_task(shard_sync_loop()))
+        if config_is_file():
+            background.append(asyncio.create_task(config_watch_loop(bots)))
+
+        if BOT_MODE == "webhook":
+            servers.append(webhook_server())
+            server_tasks.append(asyncio.create_task(servers[-1].serve()))
+        if METRICS_PORT:
+            servers.append(metrics_server())
+            server_tasks.append(asyncio.create_task(serve_metrics(servers[-1])))
+
+        # 🚀 سب bots ایک ساتھ start کرو
+        startup_tasks = await start_bots(tokens, bots)
 
-            except Exception as e:
-                logger.error(f"Failed to start bot {bot_key}: {e}")
-        
         # ♾️ main loop
         while True:
             await asyncio.sleep(3600)
@@ -497,27 +2578,46 @@ async def main():
         logger.warning("Main loop cancelled. Shutting down bots...")
     
     finally:
-        # ✅ Graceful shutdown for all bots
-        for bot in bots:
-            try:
-                await bot.updater.stop()
-            except Exception as e:
-                logger.error(f"Error stopping updater: {e}")
+        # stop accepting updates first, let uvicorn finish open requests
+        for server in servers:
+            server.should_exit = True
+        if servers:
             try:
-                await bot.stop()
+                await asyncio.wait_for(asyncio.gather(*server_tasks, return_exceptions=True), 10)
             except Exception as e:
-                logger.error(f"Error stopping bot: {e}")
-            try:
-                await bot.shutdown()
-            except Exception as e:
-                logger.error(f"Error during shutdown: {e}")
+                logger.error(f"Error stopping HTTP servers: {e}")
+        for task in background + startup_tasks + list(bot_tasks.values()):
+            task.cancel()
+        # polling bots stop fetching updates too, so no claim starts during the grace period
+        await asyncio.gather(
+            *(app.updater.stop() for app in bots if app.updater and app.updater.running),
+            return_exceptions=True,
+        )
+
+        # running claims and queued replies get SHUTDOWN_GRACE seconds in total
+        shutdown_deadline = time.monotonic() + SHUTDOWN_GRACE
+        await claim_scheduler.stop(SHUTDOWN_GRACE)
+        upstream_poller.stop()
+        await drain_outboxes(shutdown_deadline - time.monotonic())
+
+        # ✅ Graceful shutdown for all bots, in parallel
+        await asyncio.gather(*(stop_bot(bot) for bot in bots))
         
         await close_session()
+        await state_store.close()
         logger.info("All bots stopped and session closed.")
 
 
 if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        logger.info("Bot stopped by user")
\ No newline at end of file
+    if BOT_WORKERS > 1:
+        supervise()
+    else:
+        async def runner():
+            # docker stop / systemd send SIGTERM, shut down as on Ctrl-C
+            cancel_on_sigterm()
+            await main()
+
+        try:
+            asyncio.run(runner())
+        except KeyboardInterrupt:
+            logger.info("Bot stopped by user")
\ No newline at end of file